@@ -2,6 +2,46 @@ import json
 from PIL import Image, ImageDraw
 import os
 
+def mark_sheet(img, position_data, answers, radius=8, fill="black"):
+    """
+    Fill the chosen bubble of each question on a PIL image, in place.
+    answers maps question number -> choice (None or missing = unanswered);
+    a list/tuple of choices marks a multiple answer.
+    Returns how many bubbles were filled.
+    """
+    draw = ImageDraw.Draw(img)
+    marked_count = 0
+    for q_data in position_data['bubble_positions']:
+        answer = answers.get(q_data['question'])
+        if not answer:
+            continue
+        chosen = answer if isinstance(answer, (list, tuple)) else (answer,)
+        for bubble in q_data['bubbles']:
+            if bubble['choice'] in chosen:
+                cx, cy = bubble['center']
+                # Fill the bubble
+                draw.ellipse([cx-radius, cy-radius, cx+radius, cy+radius], fill=fill)
+                marked_count += 1
+    return marked_count
+
+def mark_student_id(img, position_data, student_id, radius=8, fill="black"):
+    """
+    Fill one bubble per digit column of the student ID grid, in place.
+    Returns how many bubbles were filled.
+    """
+    draw = ImageDraw.Draw(img)
+    columns = position_data.get('fields', {}).get('student_id', {}).get('bubble_positions', [])
+    if len(str(student_id)) > len(columns):
+        raise ValueError(f"Student ID {student_id} has more digits than the sheet's {len(columns)} columns")
+    marked_count = 0
+    for column, digit in zip(columns, str(student_id)):
+        for bubble in column['bubbles']:
+            if bubble['choice'] == digit:
+                cx, cy = bubble['center']
+                draw.ellipse([cx-radius, cy-radius, cx+radius, cy+radius], fill=fill)
+                marked_count += 1
+    return marked_count
+
 def create_marked_demo_sheet():
     """
     Create a marked answer sheet by asking for each question's answer
@@ -52,20 +92,7 @@ def create_marked_demo_sheet():
     
     try:
         img = Image.open(template_name)
-        draw = ImageDraw.Draw(img)
-        
-        marked_count = 0
-        for q_data in position_data['bubble_positions']:
-            q_num = q_data['question']
-            if q_num <= num_questions and user_answers.get(q_num):
-                answer = user_answers[q_num]
-                for bubble in q_data['bubbles']:
-                    if bubble['choice'] == answer:
-                        cx, cy = bubble['center']
-                        # Fill the bubble
-                        draw.ellipse([cx-8, cy-8, cx+8, cy+8], fill="black")
-                        marked_count += 1
-                        break
+        marked_count = mark_sheet(img, position_data, user_answers)
         
         # Save marked sheet
         output_name = "my_marked_sheet.png"
@@ -109,17 +136,7 @@ def quick_demo():
             position_data = json.load(f)
         
         img = Image.open(template_name)
-        draw = ImageDraw.Draw(img)
-        
-        for q_data in position_data['bubble_positions']:
-            q_num = q_data['question']
-            if q_num in demo_answers:
-                answer = demo_answers[q_num]
-                for bubble in q_data['bubbles']:
-                    if bubble['choice'] == answer:
-                        cx, cy = bubble['center']
-                        draw.ellipse([cx-8, cy-8, cx+8, cy+8], fill="black")
-                        break
+        mark_sheet(img, position_data, demo_answers)
         
         output_name = "./templates/marked_demo.png"
         img.save(output_name)
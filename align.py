@@ -0,0 +1,162 @@
+import cv2
+import numpy as np
+
+# Matching is done with the mark at roughly this many pixels across
+MATCH_MARK_SIZE = 15
+
+# A fitted homography is only trusted when every mark it was fitted from
+# lands within this share of a bubble diameter of where it was found...
+MAX_MARK_RESIDUAL = 0.2
+# ...it stays this close to the template's scale...
+MAX_SCALE_CHANGE = 0.15
+# ...and its perspective terms change the scale by at most this share
+# across the page
+MAX_PERSPECTIVE = 0.1
+
+CORNER_MARKS = ('cross', 'L', 'square', 'circle')
+
+def render_mark(mark_type, size):
+    """
+    Draw a reference mark (black on white) the way the generator does.
+    Returns (patch, anchor) where anchor is the (x, y) of the mark's
+    reference point inside the patch.
+    """
+    size = int(round(size))
+    pad = max(3, size // 3)
+    thickness = max(1, int(round(size / 5)))
+
+    if mark_type == 'tick':
+        patch = np.full((2 * pad + 1, size + 2 * pad), 255, dtype=np.uint8)
+        cv2.line(patch, (pad, pad), (pad + size, pad), 0, max(1, thickness - 1))
+        return patch, (pad + size / 2, pad)
+
+    patch = np.full((size + 2 * pad, size + 2 * pad), 255, dtype=np.uint8)
+    if mark_type == 'cross':
+        cv2.line(patch, (pad, pad), (pad + size, pad), 0, thickness)
+        cv2.line(patch, (pad, pad), (pad, pad + size), 0, thickness)
+        anchor = (pad, pad)
+    elif mark_type == 'L':
+        cv2.line(patch, (pad + size, pad), (pad, pad), 0, thickness)
+        cv2.line(patch, (pad + size, pad), (pad + size, pad + size), 0, thickness)
+        anchor = (pad + size, pad)
+    elif mark_type == 'square':
+        cv2.rectangle(patch, (pad, pad), (pad + size, pad + size), 0, thickness)
+        anchor = (pad + size / 2, pad + size / 2)
+    elif mark_type == 'circle':
+        center = (pad + size // 2, pad + size // 2)
+        cv2.circle(patch, center, size // 2, 0, thickness)
+        anchor = (pad + size / 2, pad + size / 2)
+    else:
+        raise ValueError(f"Unknown reference mark type: {mark_type}")
+    return patch, anchor
+
+def locate_mark(gray, mark, min_score=0.5):
+    """
+    Find one reference mark inside its search window only. The crop is
+    downscaled so the mark is about MATCH_MARK_SIZE pixels across before
+    template matching. Returns ((x, y), score) in page pixels, or None.
+    """
+    h, w = gray.shape[:2]
+    x1, y1, x2, y2 = mark['search_window']
+    x1, y1 = max(0, int(x1)), max(0, int(y1))
+    x2, y2 = min(w, int(x2)), min(h, int(y2))
+    if x2 <= x1 or y2 <= y1:
+        return None
+
+    downscale = max(1.0, mark['size'] / MATCH_MARK_SIZE)
+    crop = gray[y1:y2, x1:x2]
+    if downscale > 1:
+        crop = cv2.resize(crop, None, fx=1 / downscale, fy=1 / downscale, interpolation=cv2.INTER_AREA)
+
+    patch, anchor = render_mark(mark['type'], mark['size'] / downscale)
+    if crop.shape[0] < patch.shape[0] or crop.shape[1] < patch.shape[1]:
+        return None
+
+    response = cv2.matchTemplate(crop, patch, cv2.TM_CCOEFF_NORMED)
+    _, score, _, loc = cv2.minMaxLoc(response)
+    if not np.isfinite(score) or score < min_score:
+        return None
+
+    x = x1 + (loc[0] + anchor[0]) * downscale
+    y = y1 + (loc[1] + anchor[1]) * downscale
+    return (x, y), score
+
+def check_homography(homography, src, dst, image_shape, bubble_diameter=None):
+    """
+    Why a homography fitted from marks src -> dst cannot be trusted, or
+    None when it can: with only a handful of marks, one mark matched on
+    nearby print still gives an exact-looking fit.
+    """
+    homography = homography / homography[2, 2]
+    projected = cv2.perspectiveTransform(src.reshape(-1, 1, 2).astype(np.float64), homography).reshape(-1, 2)
+    residual = float(np.linalg.norm(projected - dst, axis=1).max())
+    limit = MAX_MARK_RESIDUAL * bubble_diameter if bubble_diameter else 4.0
+    if residual > limit:
+        return f"marks do not fit one homography (residual {residual:.1f}px)"
+
+    scales = np.linalg.svd(homography[:2, :2], compute_uv=False)
+    if abs(scales[0] - 1) > MAX_SCALE_CHANGE or abs(scales[1] - 1) > MAX_SCALE_CHANGE:
+        return f"homography scales the page by {scales[1]:.2f}-{scales[0]:.2f}"
+
+    h, w = image_shape[:2]
+    if abs(homography[2, 0]) * w + abs(homography[2, 1]) * h > MAX_PERSPECTIVE:
+        return "homography has too much perspective"
+    return None
+
+def estimate_homography(gray, template, min_score=0.5):
+    """
+    Locate the template's reference marks on a scan and fit the homography
+    mapping template coordinates onto it. Returns (homography, info) where
+    homography is None when fewer than four marks were found, or when
+    fewer than three of them are corners or the fit fails check_homography;
+    info['rejected'] then says why.
+    """
+    expected = []
+    found = []
+    corners = 0
+    for mark in template.reference_marks:
+        located = locate_mark(gray, mark, min_score)
+        if located is not None:
+            expected.append(mark['position'])
+            found.append(located[0])
+            corners += mark['type'] in CORNER_MARKS
+
+    info = {'marks_found': len(found), 'marks_total': len(template.reference_marks)}
+    if len(found) < 4:
+        return None, info
+    if corners < 3:
+        info['rejected'] = f"only {corners} corner marks found"
+        return None, info
+
+    src = np.array(expected, dtype=np.float32)
+    dst = np.array(found, dtype=np.float32)
+    homography, inliers = cv2.findHomography(src, dst, cv2.RANSAC, 3.0)
+    if homography is None:
+        info['rejected'] = "no homography fits the marks"
+        return None, info
+
+    info['marks_used'] = int(inliers.sum()) if inliers is not None else len(found)
+    info['max_shift'] = float(np.abs(dst - src).max())
+    rejected = check_homography(homography, src, dst, gray.shape, template.bubble_diameter)
+    if rejected is not None:
+        info['rejected'] = rejected
+        return None, info
+    return homography, info
+
+def align_template(gray, template, min_score=0.5):
+    """
+    Map the template's bubbles onto a possibly shifted, rotated or skewed
+    scan without warping the page. Falls back to the unaligned template
+    when the marks cannot be found; info['rejected'] is set when they were
+    found but gave an untrustworthy fit. Returns (template, info).
+    """
+    if not template.reference_marks:
+        return template, {'aligned': False, 'marks_found': 0, 'marks_total': 0}
+
+    homography, info = estimate_homography(gray, template, min_score)
+    info['aligned'] = homography is not None
+    if homography is None:
+        return template, info
+    # Kept so another layout of the same page can be mapped without searching again
+    info['homography'] = homography
+    return template.warped(homography), info
@@ -0,0 +1,366 @@
+import os
+import glob
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from grade_it import grade_gabarito_improved
+from compiled_template import compile_pages, load_pages, page_for_code
+from results_writer import ResultsWriter, ThreadedWriter
+from triage import ReviewQueue
+from scan_pages import count_pages, load_page, page_name
+from item_analysis import ItemAnalysis, print_item_report
+from exam_versions import KeyTable, load_answer_key
+from template_registry import TemplateRegistry
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.pdf')
+
+# Per-process grading settings, filled once by the pool initializer
+_worker_state = {}
+
+def _init_worker(pages, expected_answers, choices, threshold, details, debug_dir, metrics, review, key_table,
+                 registry):
+    _worker_state['pages'] = pages
+    _worker_state['key_table'] = key_table
+    _worker_state['registry'] = registry
+    _worker_state['expected_answers'] = expected_answers
+    _worker_state['choices'] = choices
+    _worker_state['threshold'] = threshold
+    _worker_state['details'] = details
+    _worker_state['debug_dir'] = debug_dir
+    _worker_state['metrics'] = metrics
+    _worker_state['review'] = review
+
+def _grade_one(image_path, page=None, data=None):
+    """
+    Decode, preprocess and score one sheet (or one page of a file) inside
+    a worker. data holds the file's bytes when they were prefetched.
+    """
+    sheet_name = image_path if page is None else page_name(image_path, page)
+    try:
+        if page is not None:
+            image_path = load_page(image_path, page, _worker_state['pages'][0].page_size)
+        elif data is not None:
+            image_path = data
+        results = grade_gabarito_improved(
+            image_path=image_path,
+            expected_answers=_worker_state['expected_answers'],
+            position_data=_worker_state['pages'],
+            choices=_worker_state['choices'],
+            threshold=_worker_state['threshold'],
+            debug=False,
+            details=_worker_state['details'],
+            debug_output=_worker_state['debug_dir'],
+            metrics=_worker_state['metrics'],
+            sheet_name=sheet_name,
+            key_table=_worker_state['key_table'],
+            registry=_worker_state['registry'],
+            **_worker_state['review']
+        )
+    except Exception as e:
+        return {'image_path': sheet_name, 'error': str(e)}
+
+    results['image_path'] = sheet_name
+    return results
+
+def iter_scan_paths(source):
+    """
+    Yield scan paths from a directory or a glob pattern, in sorted order
+    """
+    if os.path.isdir(source):
+        names = sorted(os.listdir(source))
+        for name in names:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(source, name)
+    else:
+        for path in sorted(glob.iglob(source)):
+            if os.path.isfile(path):
+                yield path
+
+def iter_scan_sheets(source):
+    """
+    Yield (path, page) for every sheet in the source. Plain images give
+    page None; each page of a multi-page TIFF or PDF is its own sheet, so
+    only the page number travels to the worker that decodes it.
+    """
+    for path in iter_scan_paths(source):
+        try:
+            num_pages = count_pages(path)
+        except ValueError:
+            # Unreadable PDF: let the worker report it as a failed sheet
+            num_pages = 1
+        if num_pages <= 1 and not path.lower().endswith('.pdf'):
+            yield path, None
+        else:
+            for page in range(num_pages):
+                yield path, page
+
+def _read_bytes(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        # The worker retries from the path and reports the error
+        return None
+
+def prefetch_sheets(sheets, depth=8, io_threads=4):
+    """
+    Read the files behind (path, page) sheets on background threads and
+    yield (path, page, data) in the same order, keeping at most `depth`
+    reads ahead. Pages of multi-page files are left for the worker to
+    load (data None), since it only needs the page it grades.
+    """
+    with ThreadPoolExecutor(max_workers=io_threads) as reader:
+        ahead = deque()
+        for path, page in sheets:
+            ahead.append((path, page, reader.submit(_read_bytes, path) if page is None else None))
+            if len(ahead) > depth:
+                path, page, read = ahead.popleft()
+                yield path, page, read.result() if read is not None else None
+        while ahead:
+            path, page, read = ahead.popleft()
+            yield path, page, read.result() if read is not None else None
+
+def grade_batch(
+    source,
+    expected_answers,
+    position_data,
+    choices=("A", "B", "C", "D", "E"),
+    threshold=0.2,
+    max_workers=None,
+    max_in_flight=None,
+    details=False,
+    debug_dir=None,
+    metrics=False,
+    review_limit=None,
+    review_margin=0.1,
+    review_dir=None,
+    key_table=None,
+    prefetch=8,
+    io_threads=4,
+    registry=None
+):
+    """
+    Grade every scan in a directory or glob across a process pool.
+
+    Results are yielded as soon as each sheet finishes (not in input order),
+    each one tagged with its 'image_path' (for a page of a multi-page TIFF
+    or PDF, the file name plus the page number). A sheet that fails to
+    grade yields {'image_path': ..., 'error': ...} instead of stopping the batch.
+    At most max_in_flight sheets are queued at once, so memory stays flat
+    regardless of how many files the source holds. Per-question result
+    dicts are only built with details=True; 'answers' and 'fill_ratios'
+    are always there. With debug_dir set, annotated crops of anomalous
+    questions are written there per sheet (see grade_gabarito_improved).
+    metrics=True attaches the per-stage timings and counters as
+    results['metrics'] so the consumer can forward them to an exporter.
+    With review_limit set every sheet carries results['review']: None when
+    it is clear, otherwise its low-confidence questions (thumbnails go to
+    review_dir), so the consumer can route it to a ReviewQueue.
+    With a key_table (see exam_versions.KeyTable) each sheet's printed
+    version picks its layout and key, tagged as results['version'];
+    position_data and expected_answers may then be None.
+    position_data may hold the pages of a multi-page layout; each sheet's
+    printed layout code picks its page, tagged as results['layout_code'].
+    With a registry (see template_registry.TemplateRegistry) each sheet's
+    printed layout code picks its exam, so mixed stacks grade in one pass;
+    results carry 'exam' and 'layout_code'.
+    prefetch=N reads up to N files ahead on io_threads background threads
+    and hands their bytes to the workers (cv2.imdecode), so slow or
+    network storage is read while earlier sheets are being graded (default
+    8, as on the command line); prefetch=0 lets each worker read its own file.
+    """
+    if position_data is None and registry is not None:
+        position_data = registry.reader
+    if position_data is None and key_table is not None:
+        position_data = key_table.pages
+    if position_data is None:
+        raise ValueError("Batch grading needs position data")
+
+    # Compiled once here, then shipped to each worker a single time
+    pages = compile_pages(position_data)
+
+    max_workers = max_workers or os.cpu_count() or 1
+    max_in_flight = max(max_in_flight or max_workers * 2, 1)
+    review = {'review_limit': review_limit, 'review_margin': review_margin, 'review_dir': review_dir}
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_worker,
+        initargs=(pages, expected_answers, choices, threshold, details, debug_dir, metrics, review, key_table,
+                  registry)
+    ) as executor:
+        pending = set()
+        try:
+            sheets = iter_scan_sheets(source)
+            if prefetch:
+                sheets = prefetch_sheets(sheets, prefetch, io_threads)
+            else:
+                sheets = ((image_path, page, None) for image_path, page in sheets)
+
+            for image_path, page, data in sheets:
+                pending.add(executor.submit(_grade_one, image_path, page, data))
+
+                # Wait for a slot before reading more paths
+                while len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            # Consumer stopped early: drop whatever has not started yet
+            for future in pending:
+                future.cancel()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Grade a directory of scanned answer sheets")
+    parser.add_argument("source", help="Directory of scans or a glob such as 'scans/*.png' (multi-page TIFF/PDF included)")
+    parser.add_argument("position_file", nargs="?",
+                        help="Positions JSON or .tpl written by gen_gabarito.py (multi-page layouts included)")
+    parser.add_argument("answers", nargs="?", help="Answer key, e.g. 'A,B,C,D' or a file holding it")
+    parser.add_argument("--key-table", default=None,
+                        help="JSON mapping each exam version to its positions file and key (replaces the two above)")
+    parser.add_argument("--registry", default=None,
+                        help="JSON naming every exam of a mixed stack with its positions file and key, "
+                             "or key table; sheets are matched by their printed layout code")
+    parser.add_argument("--threshold", default="0.2", help="Fill threshold, or 'auto' for a per-sheet threshold")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument("--in-flight", type=int, default=None, help="Max sheets queued at once (default: 2x workers)")
+    parser.add_argument("--prefetch", type=int, default=8,
+                        help="Files read ahead on background threads while sheets are graded (0 = off)")
+    parser.add_argument("--io-threads", type=int, default=4, help="Threads reading files for --prefetch")
+    parser.add_argument("--output", default=None, help="Write one row per sheet to a .csv or .jsonl file")
+    parser.add_argument("--ratios", action="store_true", help="Include the fill ratio matrix in --output rows")
+    parser.add_argument("--debug-dir", default=None, help="Write annotated crops of anomalous sheets here")
+    parser.add_argument("--metrics", action="store_true", help="Print mean time per pipeline stage at the end")
+    parser.add_argument("--item-stats", action="store_true",
+                        help="Print difficulty, discrimination and choice counts per question at the end")
+    parser.add_argument("--item-csv", default=None, help="Also write the item statistics to this CSV file")
+    parser.add_argument("--review-queue", default=None,
+                        help="Send sheets with low-confidence questions to this .jsonl file instead of --output")
+    parser.add_argument("--review-limit", type=int, default=0,
+                        help="Low-confidence questions a sheet may have before it goes to review (default 0)")
+    parser.add_argument("--review-margin", type=float, default=0.1,
+                        help="Distance from the threshold below which a question counts as low confidence")
+    parser.add_argument("--review-dir", default=None,
+                        help="Write cropped thumbnails of the flagged questions here (default: next to the queue)")
+    args = parser.parse_args()
+
+    key_table = KeyTable.load(args.key_table) if args.key_table else None
+    registry = TemplateRegistry.load(args.registry) if args.registry else None
+    if key_table is None and registry is None and (args.position_file is None or args.answers is None):
+        parser.error("give a position file and answer key, --key-table or --registry")
+
+    pages = load_pages(args.position_file) if args.position_file else None
+    expected_answers = load_answer_key(args.answers) if args.answers else None
+
+    # Rows are written on their own thread so output storage never stalls grading
+    writer = ThreadedWriter(ResultsWriter(args.output, include_ratios=args.ratios)) if args.output else None
+
+    review_queue = None
+    review_dir = args.review_dir
+    if args.review_queue:
+        review_queue = ThreadedWriter(ReviewQueue(args.review_queue))
+        if review_dir is None:
+            review_dir = os.path.splitext(args.review_queue)[0] + "_thumbs"
+
+    graded = 0
+    failed = 0
+    flagged = 0
+    # One item analysis per exam page and version, each against its own key
+    analyses = {}
+    labels = {}
+    stage_totals = {}
+    # Closing drains the writer threads, so rows already queued reach the
+    # files even when grading stops on an error or Ctrl-C
+    try:
+        for results in grade_batch(
+            args.source,
+            expected_answers,
+            pages,
+            threshold=args.threshold if args.threshold == "auto" else float(args.threshold),
+            max_workers=args.workers,
+            max_in_flight=args.in_flight,
+            debug_dir=args.debug_dir,
+            metrics=args.metrics,
+            review_limit=args.review_limit if review_queue is not None else None,
+            review_margin=args.review_margin,
+            review_dir=review_dir,
+            key_table=key_table,
+            prefetch=args.prefetch,
+            io_threads=args.io_threads,
+            registry=registry
+        ):
+            if review_queue is not None and results.get('review'):
+                review_queue.write(results)
+                flagged += 1
+            elif writer is not None:
+                writer.write(results)
+
+            if 'error' in results:
+                failed += 1
+                print(f"{results['image_path']}: ERROR {results['error']}")
+            else:
+                graded += 1
+                if args.item_stats or args.item_csv:
+                    version = results.get('version')
+                    layout_code = results.get('layout_code')
+                    group = (results.get('exam'), layout_code, version)
+                    if group not in analyses:
+                        table, key = key_table, expected_answers
+                        layout = pages[0] if pages else None
+                        parts = [version]
+                        if registry is not None:
+                            layout, key, table, exam = registry.select(layout_code)
+                            exam_pages = sum(entry[3] == exam for entry in registry.entries.values())
+                            parts = [exam, layout_code if exam_pages > 1 else None, version]
+                        elif layout_code is not None:
+                            # One analysis per page of a multi-page layout
+                            parts = [layout_code, version]
+                            if table is None:
+                                layout = page_for_code(pages, layout_code)
+                        if table is not None:
+                            layout, key = table.select(version, layout_code)
+                        analyses[group] = ItemAnalysis(layout, key)
+                        labels[group] = [str(part) for part in parts if part is not None]
+                    analyses[group].add_results(results)
+                if args.metrics:
+                    for stage, seconds in results['metrics']['stages'].items():
+                        stage_totals[stage] = stage_totals.get(stage, 0.0) + seconds
+                print(f"{results['image_path']}: {results['total_score']}/{results['max_score']} "
+                      f"({results['percentage']:.1f}%) " + (f"exam={results['exam']} " if registry else "") +
+                      (f"version={results['version']} " if results.get('version') else "") +
+                      (f"id={results['student_id']} " if results.get('student_id') else "") +
+                      f"multi={results['multiple_answers']} "
+                      f"none={results['unanswered']}" + (" REVIEW" if results.get('review') else ""))
+    finally:
+        if writer is not None:
+            writer.close()
+        if review_queue is not None:
+            review_queue.close()
+    if writer is not None:
+        print(f"Results written to {args.output}")
+    if review_queue is not None:
+        print(f"{flagged} sheets queued for review in {args.review_queue}")
+
+    print(f"\nGraded {graded} sheets, {failed} failed")
+    if stage_totals and graded:
+        print("Mean time per sheet: " + ", ".join(
+            f"{stage}={seconds / graded * 1000:.2f}ms" for stage, seconds in stage_totals.items()))
+
+    for group, analysis in sorted(analyses.items(), key=lambda item: labels[item[0]]):
+        label = labels[group]
+        if label:
+            print(f"\n--- {' / '.join(label)} ---")
+        if args.item_stats:
+            print_item_report(analysis)
+        if args.item_csv:
+            path = args.item_csv
+            if label:
+                root, ext = os.path.splitext(path)
+                path = f"{root}_{'_'.join(label)}{ext}"
+            print(f"Item statistics written to {analysis.write_csv(path)}")
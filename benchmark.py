@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import importlib.util
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from gen_gabarito import generate_gabarito_png_improved
+from compiled_template import compile_template
+from grade_it import grade_gabarito_improved
+from results_writer import compact_row
+
+STAGES = ('decode', 'align', 'preprocess', 'score', 'report')
+
+# Share of questions drawn with each fill pattern
+DEFAULT_FILL_MIX = {'single': 0.85, 'light': 0.05, 'multi': 0.05, 'blank': 0.05}
+
+def _load_marker():
+    """Import the marking helpers from '[testing]mark_gabarito.py'"""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "[testing]mark_gabarito.py")
+    spec = importlib.util.spec_from_file_location("mark_gabarito", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def synthesize_sheet(blank, position_data, rng, marker, scale=1.0, noise=0.0, rotation=0.0,
+                     shift=0, fill_mix=DEFAULT_FILL_MIX):
+    """
+    Mark a copy of the blank template with random answers, then distort it
+    like a scan: rotate/shift, resample to `scale` and add Gaussian noise.
+    Returns (gray_page, expected_answers) where expected_answers holds the
+    choice, 'MULTI' or 'NONE' the grader should read for every question.
+    """
+    choices = list(position_data['choices'])
+    patterns = list(fill_mix)
+    weights = np.array([fill_mix[p] for p in patterns], dtype=np.float64)
+    weights /= weights.sum()
+
+    solid, light = {}, {}
+    expected = []
+    for q_data in position_data['bubble_positions']:
+        q_num = q_data['question']
+        pattern = patterns[rng.choice(len(patterns), p=weights)]
+        if pattern == 'blank':
+            expected.append('NONE')
+        elif pattern == 'multi':
+            picked = rng.choice(len(choices), size=2, replace=False)
+            solid[q_num] = [choices[i] for i in picked]
+            expected.append('MULTI')
+        else:
+            answer = choices[rng.integers(len(choices))]
+            (light if pattern == 'light' else solid)[q_num] = answer
+            expected.append(answer)
+
+    img = blank.copy()
+    marker.mark_sheet(img, position_data, solid)
+    marker.mark_sheet(img, position_data, light, fill=(110, 110, 110))
+    page = np.array(img.convert("L"))
+
+    h, w = page.shape
+    if rotation or shift:
+        angle = rng.uniform(-rotation, rotation)
+        matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+        matrix[:, 2] += rng.uniform(-shift, shift, size=2)
+        page = cv2.warpAffine(page, matrix, (w, h), borderValue=255)
+
+    if scale != 1.0:
+        page = cv2.resize(page, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+
+    if noise > 0:
+        page = np.clip(page + rng.normal(0, noise, page.shape), 0, 255).astype(np.uint8)
+
+    return page, expected
+
+def grade_timed(image_path, template, expected_answers, threshold=0.2):
+    """
+    Grade one file with stage metrics on, then time building its report row.
+    Returns (results, {stage: seconds}).
+    """
+    results = grade_gabarito_improved(image_path, expected_answers, template, threshold=threshold,
+                                      details=False, metrics=True)
+    timings = dict(results['metrics']['stages'])
+
+    start = time.perf_counter()
+    json.dumps(compact_row(results, sheet=image_path))
+    timings['report'] = time.perf_counter() - start
+
+    return results, timings
+
+def run_benchmark(num_sheets=20, question_counts=(15, 30, 50), scales=(1.0, 2.0), noise=8.0,
+                  rotation=1.0, shift=6, fill_mix=DEFAULT_FILL_MIX, seed=0, threshold=0.2, paper="A4"):
+    """
+    Synthesize num_sheets marked scans for every (question count, scale)
+    pair and grade them one by one. Returns one summary dict per config
+    with throughput, p50/p99 latency, mean time per stage and how many
+    questions were read back correctly. Templates are laid out on `paper`.
+    """
+    marker = _load_marker()
+    rng = np.random.default_rng(seed)
+    summaries = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for num_questions in question_counts:
+            template_file = os.path.join(workdir, f"template_{num_questions}.png")
+            _, position_data = generate_gabarito_png_improved(template_file, num_questions=num_questions, paper=paper)
+            if 'pages' in position_data:
+                raise ValueError(f"{num_questions} questions do not fit one {paper or 'default'} page")
+            position_data = json.loads(json.dumps(position_data))
+            blank = Image.open(template_file).convert("RGB")
+            template = compile_template(position_data)
+
+            for scale in scales:
+                sheets = []
+                for i in range(num_sheets):
+                    page, expected = synthesize_sheet(blank, position_data, rng, marker, scale,
+                                                      noise, rotation, shift, fill_mix)
+                    path = os.path.join(workdir, f"sheet_{num_questions}_{scale}_{i}.png")
+                    cv2.imwrite(path, page)
+                    sheets.append((path, expected))
+
+                latencies = []
+                stage_totals = dict.fromkeys(STAGES, 0.0)
+                read_correctly = 0
+                total_questions = 0
+
+                wall_start = time.perf_counter()
+                for path, expected in sheets:
+                    key = [a if a not in ('MULTI', 'NONE') else 'A' for a in expected]
+                    results, timings = grade_timed(path, template, key, threshold)
+                    latencies.append(sum(timings.values()))
+                    for stage, seconds in timings.items():
+                        stage_totals[stage] = stage_totals.get(stage, 0.0) + seconds
+                    read_correctly += sum(a == e for a, e in zip(results['answers'], expected))
+                    total_questions += len(expected)
+                wall = time.perf_counter() - wall_start
+
+                for path, _ in sheets:
+                    os.remove(path)
+
+                latencies_ms = np.array(latencies) * 1000
+                summaries.append({
+                    'questions': num_questions,
+                    'scale': scale,
+                    'sheets': num_sheets,
+                    'sheets_per_sec': num_sheets / wall if wall > 0 else float('inf'),
+                    'p50_ms': float(np.percentile(latencies_ms, 50)),
+                    'p99_ms': float(np.percentile(latencies_ms, 99)),
+                    'stage_ms': {stage: stage_totals[stage] / num_sheets * 1000 for stage in STAGES},
+                    'read_accuracy': read_correctly / total_questions if total_questions else 0.0
+                })
+
+    return summaries
+
+def print_benchmark(summaries):
+    print(f"\n=== BENCHMARK ===")
+    header = f"{'questions':>9} {'scale':>5} {'sheets/s':>9} {'p50 ms':>8} {'p99 ms':>8} "
+    header += " ".join(f"{stage:>10}" for stage in STAGES) + f" {'read ok':>8}"
+    print(header)
+    for s in summaries:
+        line = f"{s['questions']:>9} {s['scale']:>5.1f} {s['sheets_per_sec']:>9.1f} {s['p50_ms']:>8.2f} {s['p99_ms']:>8.2f} "
+        line += " ".join(f"{s['stage_ms'][stage]:>10.2f}" for stage in STAGES)
+        line += f" {s['read_accuracy'] * 100:>7.1f}%"
+        print(line)
+    print("(stage columns are mean ms per sheet)")
+
+def _parse_list(text, cast):
+    return tuple(cast(x) for x in text.split(',') if x.strip())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the generate -> mark -> grade pipeline")
+    parser.add_argument("--sheets", type=int, default=20, help="Sheets per configuration")
+    parser.add_argument("--questions", default="15,30,50", help="Comma separated question counts")
+    parser.add_argument("--scales", default="1,2", help="Comma separated scan scales relative to the template")
+    parser.add_argument("--noise", type=float, default=8.0, help="Gaussian noise sigma (grey levels)")
+    parser.add_argument("--rotation", type=float, default=1.0, help="Max rotation in degrees")
+    parser.add_argument("--shift", type=float, default=6, help="Max shift in template pixels")
+    parser.add_argument("--paper", default="A4", help="Paper format the sheets are laid out on")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threshold", default="0.2", help="Fill threshold, or 'auto' for a per-sheet threshold")
+    parser.add_argument("--json", default=None, help="Also write the summaries to this JSON file")
+    args = parser.parse_args()
+
+    summaries = run_benchmark(
+        num_sheets=args.sheets,
+        question_counts=_parse_list(args.questions, int),
+        scales=_parse_list(args.scales, float),
+        noise=args.noise,
+        rotation=args.rotation,
+        shift=args.shift,
+        seed=args.seed,
+        paper=args.paper,
+        threshold=args.threshold if args.threshold == "auto" else float(args.threshold)
+    )
+    print_benchmark(summaries)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summaries, f, indent=2)
+        print(f"Saved to {args.json}")
@@ -0,0 +1,230 @@
+import os
+import csv
+import json
+import zlib
+import argparse
+
+from PIL import TiffImagePlugin
+
+from gen_gabarito import get_layout
+
+# Roster columns (lower case) that carry the version and the student ID;
+# every other column is written on the subtitle blank with the same label
+VERSION_COLUMNS = ('version', 'versao', 'versão')
+ID_COLUMNS = ('student_id', 'id', 'matricula', 'matrícula')
+FIELD_ALIASES = {'name': 'nome', 'number': 'numero', 'class': 'turma'}
+
+class PdfPageWriter:
+    """
+    Write pages to a PDF one at a time. Each page is a single grayscale
+    image, deflated and written out as soon as it is added, so only the
+    page offsets stay in memory however long the document gets.
+
+        with PdfPageWriter("sheets.pdf") as pdf:
+            for img in pages:
+                pdf.add_page(img)
+    """
+
+    def __init__(self, path, dpi=150):
+        self.path = path
+        self.dpi = dpi
+        self.pages = 0
+        self._offsets = {}
+        self._kids = []
+        # 1 and 2 are the catalog and page tree, written when closing
+        self._next_obj = 3
+        self._file = open(path, 'wb')
+        self._file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write_obj(self, body, stream=None):
+        num = self._next_obj
+        self._next_obj += 1
+        self._write_numbered(num, body, stream)
+        return num
+
+    def _write_numbered(self, num, body, stream=None):
+        self._offsets[num] = self._file.tell()
+        self._file.write(f"{num} 0 obj\n".encode() + body)
+        if stream is not None:
+            self._file.write(b"\nstream\n" + stream + b"\nendstream")
+        self._file.write(b"\nendobj\n")
+
+    def add_page(self, img):
+        gray = img.convert("L")
+        width, height = gray.size
+        data = zlib.compress(gray.tobytes(), 6)
+        image = self._write_obj(
+            f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace /DeviceGray "
+            f"/BitsPerComponent 8 /Filter /FlateDecode /Length {len(data)} >>".encode(), data)
+
+        page_w = width * 72 / self.dpi
+        page_h = height * 72 / self.dpi
+        content = f"q {page_w:.2f} 0 0 {page_h:.2f} 0 0 cm /Im0 Do Q".encode()
+        contents = self._write_obj(f"<< /Length {len(content)} >>".encode(), content)
+        self._kids.append(self._write_obj(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_w:.2f} {page_h:.2f}] "
+            f"/Resources << /XObject << /Im0 {image} 0 R >> >> /Contents {contents} 0 R >>".encode()))
+        self.pages += 1
+
+    def close(self):
+        if self._file.closed:
+            return
+        kids = " ".join(f"{k} 0 R" for k in self._kids)
+        self._write_numbered(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self._kids)} >>".encode())
+        self._write_numbered(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+
+        xref = self._file.tell()
+        size = self._next_obj
+        lines = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+        lines += [f"{self._offsets[num]:010d} 00000 n \n" for num in range(1, size)]
+        lines.append(f"trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n")
+        self._file.write("".join(lines).encode())
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class TiffPageWriter:
+    """Write pages to a multi-page TIFF one at a time (deflate-compressed grayscale)"""
+
+    def __init__(self, path, dpi=150):
+        self.path = path
+        self.dpi = dpi
+        self.pages = 0
+        self._tiff = TiffImagePlugin.AppendingTiffWriter(path, new=True)
+
+    def add_page(self, img):
+        img.convert("L").save(self._tiff, format="TIFF", compression="tiff_adobe_deflate", dpi=(self.dpi, self.dpi))
+        self._tiff.newFrame()
+        self.pages += 1
+
+    def close(self):
+        if not self._tiff.closed:
+            self._tiff.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_page_writer(path, dpi=150):
+    """PdfPageWriter or TiffPageWriter, picked by the file extension"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.pdf':
+        return PdfPageWriter(path, dpi)
+    if ext in ('.tif', '.tiff'):
+        return TiffPageWriter(path, dpi)
+    raise ValueError(f"Bulk output must be a .pdf or .tif file, got {path}")
+
+def roster_columns(fieldnames):
+    """(version column, ID column, {column: subtitle label}) of a roster header"""
+    version_column = id_column = None
+    field_columns = {}
+    for column in fieldnames:
+        key = column.strip().lower()
+        if key in VERSION_COLUMNS:
+            version_column = column
+        elif key in ID_COLUMNS:
+            id_column = column
+        else:
+            field_columns[column] = FIELD_ALIASES.get(key, key)
+    return version_column, id_column, field_columns
+
+def generate_roster_sheets(roster_path, output, num_questions=50, choices=("A", "B", "C", "D", "E"),
+                           versions=("A", "B", "C", "D"), student_id_digits=0, title="GABARITO FIXO",
+                           paper=None, orientation="landscape", dpi=150, write_positions=True, layout_code=None):
+    """
+    Render one pre-filled sheet per roster row into a single multi-page
+    PDF or TIFF. The roster is a CSV with a header; a version column
+    (version/versao) marks the version bubble, an ID column
+    (student_id/id/matricula) is written in the ID boxes and pre-filled in
+    the grid, and any other column whose name matches a subtitle blank
+    (Nome/Numero/Turma, or name/number/class) is written on it.
+
+    The layout is built and its blank pages drawn once, at `dpi`; each
+    page is a copy with the row stamped on, written out before the next
+    row is read. Layouts spanning several pages give every student all of
+    them in order. Positions files for grading are written next to the
+    output (one per version when the roster has versions). layout_code
+    sets the number printed to identify the exam (see SheetLayout), so
+    stacks of several exams can be graded together.
+    Returns the number of pages written.
+    """
+    with open(roster_path, 'r', newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        if not reader.fieldnames:
+            raise ValueError(f"Roster {roster_path} has no header row")
+        version_column, id_column, field_columns = roster_columns(reader.fieldnames)
+        if id_column is not None and not student_id_digits:
+            raise ValueError(f"Roster has a '{id_column}' column: give the number of student ID digits")
+
+        layout = get_layout(num_questions, tuple(choices), title=title,
+                            versions=tuple(versions) if version_column else None,
+                            student_id_digits=student_id_digits, paper=paper, orientation=orientation,
+                            layout_code=layout_code)
+        # Only the columns the subtitle has a blank for are stamped
+        field_columns = {c: label for c, label in field_columns.items() if label in layout.field_slots}
+
+        # The blank pages stay on the cached layout only for this run
+        try:
+            with open_page_writer(output, dpi) as writer:
+                for line, row in enumerate(reader, start=2):
+                    version = (row.get(version_column) or '').strip().upper() if version_column else None
+                    student_id = (row.get(id_column) or '').strip() if id_column else None
+                    fields = {label: row[c].strip() for c, label in field_columns.items() if row.get(c)}
+                    for page in range(layout.num_pages):
+                        try:
+                            img = layout.render(version=version or None, student_id=student_id or None,
+                                                fields=fields, page=page, dpi=dpi)
+                        except ValueError as e:
+                            raise ValueError(f"{roster_path} line {line}: {e}")
+                        writer.add_page(img)
+                pages = writer.pages
+        finally:
+            layout.release()
+
+    if write_positions:
+        root = os.path.splitext(output)[0]
+        if layout.versions:
+            for version in layout.versions:
+                with open(f"{root}_{version}_positions.json", 'w') as f:
+                    json.dump(layout.position_data(version), f, indent=2)
+        else:
+            with open(f"{root}_positions.json", 'w') as f:
+                json.dump(layout.position_data(), f, indent=2)
+    return pages
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print one pre-filled answer sheet per student into a single PDF or TIFF")
+    parser.add_argument("roster", help="CSV with a header: version, student_id and/or Nome/Numero/Turma columns")
+    parser.add_argument("output", help="Output .pdf or .tif file")
+    parser.add_argument("--questions", type=int, default=50, help="Number of questions")
+    parser.add_argument("--choices", default="A,B,C,D,E", help="Answer choices")
+    parser.add_argument("--versions", default="A,B,C,D", help="Exam versions printed when the roster has a version column")
+    parser.add_argument("--id-digits", type=int, default=0, help="Columns of the student ID grid")
+    parser.add_argument("--title", default="GABARITO FIXO", help="Sheet title")
+    parser.add_argument("--paper", default=None, help="Paper format: A4, A5, letter, ... (default: the generator's page)")
+    parser.add_argument("--portrait", action="store_true", help="Portrait instead of landscape pages")
+    parser.add_argument("--dpi", type=int, default=150, help="Print resolution of the pages")
+    parser.add_argument("--layout-code", type=int, default=None,
+                        help="Code printed to identify the exam (default: derived from the title and layout)")
+    args = parser.parse_args()
+
+    pages = generate_roster_sheets(
+        args.roster,
+        args.output,
+        num_questions=args.questions,
+        choices=tuple(c.strip() for c in args.choices.split(',')),
+        versions=tuple(v.strip() for v in args.versions.split(',')),
+        student_id_digits=args.id_digits,
+        title=args.title,
+        paper=args.paper,
+        orientation="portrait" if args.portrait else "landscape",
+        dpi=args.dpi,
+        layout_code=args.layout_code
+    )
+    print(f"Wrote {pages} pages to {args.output}")
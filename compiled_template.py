@@ -0,0 +1,586 @@
+import os
+import sys
+import json
+import struct
+from functools import lru_cache
+
+import numpy as np
+
+# Matches the ellipse outline width drawn by generate_gabarito_png_improved
+BUBBLE_OUTLINE_WIDTH = 2
+
+# Reference mark geometry used by generate_gabarito_png_improved
+REFERENCE_MARK_SIZE = 15
+SIDE_TICK_SIZE = 10
+HEADER_HEIGHT = 40
+
+# How far from its expected spot a mark is searched for, in template pixels
+MARK_SEARCH_REACH = 45
+
+# Layout code printed under the footer: a start bit, LAYOUT_CODE_BITS
+# code bits (most significant first) and an even parity bit
+LAYOUT_CODE_BITS = 16
+
+# Binary template files: magic, little-endian uint64 header length, JSON
+# header, then every array at a 64-byte aligned offset from the data start
+TEMPLATE_MAGIC = b"GABTPL\x01\x00"
+TEMPLATE_EXTENSION = '.tpl'
+TEMPLATE_ARRAYS = ('bboxes', 'centers', 'choice_indices', 'questions', 'question_pos')
+_ALIGN = 64
+
+def default_reference_marks(page_size, margin, mark_size=REFERENCE_MARK_SIZE, header_height=HEADER_HEIGHT):
+    """
+    Reference marks as drawn by generate_gabarito_png_improved with
+    add_reference_marks=True, for position files that do not list them.
+    Each mark is {'type', 'position', 'size', 'search_window'} where
+    position is the anchor the grader locates: the corner point for the
+    'cross' and 'L' marks, the centre for 'square', 'circle' and 'tick'.
+    """
+    w, h = page_size
+    half = mark_size / 2
+    marks = [
+        {'type': 'cross', 'position': [margin, margin], 'size': mark_size},
+        {'type': 'L', 'position': [w - margin, margin], 'size': mark_size},
+        {'type': 'square', 'position': [margin + half, h - margin - half], 'size': mark_size},
+        {'type': 'circle', 'position': [w - margin - half, h - margin - half], 'size': mark_size},
+    ]
+    for i in range(3):
+        y_mark = margin + header_height + (h - 2*margin - header_height) * (i+1) // 4
+        marks.append({'type': 'tick', 'position': [margin - 10, y_mark], 'size': SIDE_TICK_SIZE})
+        marks.append({'type': 'tick', 'position': [w - margin + 10, y_mark], 'size': SIDE_TICK_SIZE})
+
+    for mark in marks:
+        mark['search_window'] = mark_search_window(mark['position'])
+    return marks
+
+def mark_search_window(position, reach=MARK_SEARCH_REACH):
+    """Square region around a mark anchor, `reach` pixels in every direction"""
+    x, y = position
+    return [int(x - reach), int(y - reach), int(x + reach), int(y + reach)]
+
+def build_bubble_mask(height, width, outline_width=BUBBLE_OUTLINE_WIDTH, inset=1):
+    """
+    Disk covering the inside of a printed bubble of the given bbox size,
+    leaving out the outline ring (plus `inset` pixels for scan blur)
+    and the bbox corners
+    """
+    radius = min(height, width) / 2 - outline_width - inset
+    if radius <= 0:
+        return np.ones((height, width), dtype=bool)
+    ys, xs = np.ogrid[:height, :width]
+    return (ys - height / 2) ** 2 + (xs - width / 2) ** 2 <= radius ** 2
+
+class CompiledTemplate:
+    """
+    Bubble layout packed into NumPy arrays, built once from the position
+    data written by generate_gabarito_png_improved and reused for every
+    sheet. Holds only plain arrays and tuples, so it pickles cheaply to
+    pool workers.
+
+    Arrays are indexed [question_index, choice_index]:
+    - bboxes: (Q, C, 4) int32 x1, y1, x2, y2
+    - centers: (Q, C, 2) int32 x, y
+    - choice_indices: (Q, C) int16 index into `choices`, -1 for padding
+    - choice_mask: (Q, C) bool, False where a question has fewer bubbles
+    - questions: (Q,) int32 question numbers
+    - question_pos: (Q, 2) float32 position of the question label
+
+    mask_groups holds one (mask, question_indices, choice_indices) entry per
+    distinct bubble size, so mask scoring gathers each size in one batch.
+    Generated sheets have a single size equal to bubble_diameter.
+
+    fields maps a name ('version', ...) to a CompiledTemplate of bubbles
+    printed outside the questions; each row of a field is one "question".
+    They are scaled and warped together with the questions.
+    layout_code is the number printed in the 'layout_code' field, which
+    identifies the page to a template_registry.TemplateRegistry.
+    """
+
+    def __init__(self, bboxes, centers, choice_indices, questions, question_pos,
+                 choices, page_size=None, margin=None, bubble_diameter=None, reference_marks=None,
+                 fields=None, version=None, layout_code=None):
+        self.bboxes = bboxes
+        self.centers = centers
+        self.choice_indices = choice_indices
+        self.choice_mask = choice_indices >= 0
+        self.questions = questions
+        self.question_pos = question_pos
+        self.choices = tuple(choices)
+        self.page_size = tuple(page_size) if page_size is not None else None
+        self.margin = margin
+        self.bubble_diameter = bubble_diameter
+        self.reference_marks = reference_marks or []
+        self.fields = fields or {}
+        self.version = version
+        self.layout_code = layout_code
+        self.mask_groups = self._build_mask_groups()
+        self._roi_tiles = {}
+        self._scaled = {}
+        # (path, page) when the arrays are mapped from a binary template file
+        self._source = None
+
+    def _build_mask_groups(self):
+        heights = self.bboxes[..., 3] - self.bboxes[..., 1]
+        widths = self.bboxes[..., 2] - self.bboxes[..., 0]
+        sizes = np.unique(np.stack([heights, widths], axis=-1)[self.choice_mask], axis=0)
+
+        groups = []
+        for height, width in sizes.tolist():
+            if height <= 0 or width <= 0:
+                continue
+            q_idx, c_idx = np.nonzero(self.choice_mask & (heights == height) & (widths == width))
+            groups.append((build_bubble_mask(height, width), q_idx, c_idx))
+        return groups
+
+    def roi_tiles(self, margin):
+        """
+        Rectangles (N, 4) x1, y1, x2, y2 covering the union of all bubbles,
+        each grown by `margin` pixels so a local threshold window centred on
+        any bubble pixel stays inside its tile. One tile per question row,
+        merged wherever they overlap. Cached per margin.
+        """
+        if margin not in self._roi_tiles:
+            tiles = []
+            for q_idx in range(self.num_questions):
+                boxes = self.bboxes[q_idx][self.choice_mask[q_idx]]
+                if len(boxes):
+                    tiles.append([
+                        int(boxes[:, 0].min()) - margin, int(boxes[:, 1].min()) - margin,
+                        int(boxes[:, 2].max()) + margin, int(boxes[:, 3].max()) + margin
+                    ])
+            self._roi_tiles[margin] = np.array(_merge_overlapping(tiles), dtype=np.int32).reshape(-1, 4)
+        return self._roi_tiles[margin]
+
+    def scaled(self, scale_x, scale_y):
+        """
+        Same layout with every coordinate scaled, for scans decoded at a
+        different resolution than the template page. Bubble sizes are scaled
+        once, so all bubbles keep sharing one mask. Cached per scale.
+        """
+        key = (round(scale_x, 4), round(scale_y, 4))
+        if key == (1.0, 1.0):
+            return self
+        if key not in self._scaled:
+            origins = np.rint(self.bboxes[..., :2] * (scale_x, scale_y))
+            sizes = np.rint((self.bboxes[..., 2:] - self.bboxes[..., :2]) * (scale_x, scale_y))
+            bboxes = np.concatenate([origins, origins + sizes], axis=-1).astype(np.int32)
+            bboxes[~self.choice_mask] = 0
+
+            self._scaled[key] = CompiledTemplate(
+                bboxes,
+                np.rint(self.centers * (scale_x, scale_y)).astype(np.int32),
+                self.choice_indices,
+                self.questions,
+                (self.question_pos * (scale_x, scale_y)).astype(np.float32),
+                self.choices,
+                page_size=(round(self.page_size[0] * scale_x), round(self.page_size[1] * scale_y))
+                          if self.page_size is not None else None,
+                margin=self.margin * min(scale_x, scale_y) if self.margin is not None else None,
+                bubble_diameter=self.bubble_diameter * min(scale_x, scale_y)
+                                if self.bubble_diameter is not None else None,
+                reference_marks=[_scale_mark(mark, scale_x, scale_y) for mark in self.reference_marks],
+                fields={name: field.scaled(scale_x, scale_y) for name, field in self.fields.items()},
+                version=self.version,
+                layout_code=self.layout_code
+            )
+        return self._scaled[key]
+
+    def warped(self, homography):
+        """
+        Same layout with the bubble centres mapped through a 3x3 homography
+        (template -> scan). Bubble sizes follow the homography's mean scale
+        and stay uniform, so masks still batch per size.
+        """
+        def apply(points):
+            flat = points.reshape(-1, 2).astype(np.float64)
+            ones = np.ones((len(flat), 1))
+            mapped = np.hstack([flat, ones]) @ np.asarray(homography, dtype=np.float64).T
+            return (mapped[:, :2] / mapped[:, 2:]).reshape(points.shape)
+
+        size_scale = float(np.sqrt(abs(np.linalg.det(np.asarray(homography)[:2, :2]))))
+        sizes = np.rint((self.bboxes[..., 2:] - self.bboxes[..., :2]) * size_scale)
+        box_centers = apply((self.bboxes[..., :2] + self.bboxes[..., 2:]) / 2)
+        origins = np.rint(box_centers - sizes / 2)
+        bboxes = np.concatenate([origins, origins + sizes], axis=-1).astype(np.int32)
+        bboxes[~self.choice_mask] = 0
+
+        return CompiledTemplate(
+            bboxes,
+            np.rint(apply(self.centers)).astype(np.int32),
+            self.choice_indices,
+            self.questions,
+            apply(self.question_pos).astype(np.float32),
+            self.choices,
+            page_size=self.page_size,
+            margin=self.margin,
+            bubble_diameter=self.bubble_diameter,
+            reference_marks=self.reference_marks,
+            fields={name: field.warped(homography) for name, field in self.fields.items()},
+            version=self.version,
+            layout_code=self.layout_code
+        )
+
+    def fit_to(self, image_shape):
+        """Scale the layout from page_size onto an image of the given shape"""
+        if self.page_size is None:
+            return self
+        h, w = image_shape[:2]
+        return self.scaled(w / self.page_size[0], h / self.page_size[1])
+
+    @property
+    def num_questions(self):
+        return len(self.questions)
+
+    @property
+    def num_choices(self):
+        return self.bboxes.shape[1]
+
+    @classmethod
+    def from_bubble_positions(cls, bubble_positions, choices=None, **layout):
+        """Pack the nested bubble_positions list into arrays"""
+        if choices is None:
+            choices = []
+            for q_data in bubble_positions:
+                for bubble in q_data['bubbles']:
+                    if bubble['choice'] not in choices:
+                        choices.append(bubble['choice'])
+        choice_lookup = {ch: i for i, ch in enumerate(choices)}
+
+        num_questions = len(bubble_positions)
+        num_choices = max((len(q['bubbles']) for q in bubble_positions), default=0)
+
+        bboxes = np.zeros((num_questions, num_choices, 4), dtype=np.int32)
+        centers = np.zeros((num_questions, num_choices, 2), dtype=np.int32)
+        choice_indices = np.full((num_questions, num_choices), -1, dtype=np.int16)
+        questions = np.zeros(num_questions, dtype=np.int32)
+        question_pos = np.zeros((num_questions, 2), dtype=np.float32)
+
+        for q_idx, q_data in enumerate(bubble_positions):
+            questions[q_idx] = q_data['question']
+            bubbles = q_data['bubbles']
+            for c_idx, bubble in enumerate(bubbles):
+                bboxes[q_idx, c_idx] = bubble['bbox']
+                centers[q_idx, c_idx] = bubble['center']
+                choice_indices[q_idx, c_idx] = choice_lookup[bubble['choice']]
+
+            # Same fallback the debug overlay always used
+            if 'question_pos' in q_data:
+                question_pos[q_idx] = q_data['question_pos']
+            elif bubbles:
+                question_pos[q_idx] = (bubbles[0]['center'][0] - 100, bubbles[0]['center'][1])
+
+        return cls(bboxes, centers, choice_indices, questions, question_pos, choices, **layout)
+
+    @classmethod
+    def from_position_data(cls, position_data):
+        """Compile the full dict saved in *_positions.json"""
+        if 'pages' in position_data:
+            raise ValueError(f"Position data spans {len(position_data['pages'])} pages; "
+                             "compile each page with compile_pages()")
+        page_size = position_data.get('page_size')
+        margin = position_data.get('margin')
+        # Older position files do not list the marks, rebuild them from the layout
+        reference_marks = position_data.get('reference_marks')
+        if reference_marks is None and page_size is not None and margin is not None:
+            reference_marks = default_reference_marks(page_size, margin)
+
+        fields = {
+            name: cls.from_bubble_positions(
+                field['bubble_positions'],
+                choices=field.get('choices'),
+                page_size=page_size,
+                margin=margin,
+                bubble_diameter=field.get('bubble_diameter', position_data.get('bubble_diameter'))
+            )
+            for name, field in position_data.get('fields', {}).items()
+        }
+
+        return cls.from_bubble_positions(
+            position_data['bubble_positions'],
+            choices=position_data.get('choices'),
+            page_size=page_size,
+            margin=margin,
+            bubble_diameter=position_data.get('bubble_diameter'),
+            reference_marks=reference_marks,
+            fields=fields,
+            version=position_data.get('version'),
+            layout_code=position_data.get('layout_code')
+        )
+
+    def __reduce_ex__(self, protocol):
+        # Templates mapped from a file travel to pool workers as (path, page, mtime)
+        # and are mapped again there, so every process shares the same pages
+        if self._source is not None:
+            return (_load_mapped_page, self._source)
+        return super().__reduce_ex__(protocol)
+
+    def to_position_data(self):
+        """Positions dict in the *_positions.json format, for export and inspection"""
+        bubble_positions = []
+        for q_idx, q_num in enumerate(self.questions.tolist()):
+            bubble_positions.append({
+                'question': q_num,
+                'bubbles': [{'choice': self.choices[choice],
+                             'center': self.centers[q_idx, c_idx].tolist(),
+                             'bbox': self.bboxes[q_idx, c_idx].tolist()}
+                            for c_idx, choice in enumerate(self.choice_indices[q_idx].tolist()) if choice >= 0],
+                'question_pos': self.question_pos[q_idx].tolist()
+            })
+        position_data = {
+            'bubble_positions': bubble_positions,
+            'page_size': list(self.page_size) if self.page_size is not None else None,
+            'margin': self.margin,
+            'bubble_diameter': self.bubble_diameter,
+            'choices': list(self.choices),
+            'reference_marks': self.reference_marks
+        }
+        if self.version is not None:
+            position_data['version'] = self.version
+        if self.layout_code is not None:
+            position_data['layout_code'] = self.layout_code
+        if self.fields:
+            position_data['fields'] = {
+                name: {'choices': list(field.choices),
+                       'bubble_diameter': field.bubble_diameter,
+                       'bubble_positions': field.to_position_data()['bubble_positions']}
+                for name, field in self.fields.items()
+            }
+        return position_data
+
+    def save(self, path):
+        """Write the template to a binary file (see save_templates)"""
+        save_templates(path, [self])
+        return path
+
+    @classmethod
+    def load(cls, position_file):
+        """Load a *_positions.json or a binary template file"""
+        if is_binary_template(position_file):
+            pages = load_templates(position_file)
+            if len(pages) > 1:
+                raise ValueError(f"{position_file} holds {len(pages)} pages; load them with load_pages()")
+            return pages[0]
+        with open(position_file, 'r') as f:
+            return cls.from_position_data(json.load(f))
+
+def _scale_mark(mark, scale_x, scale_y):
+    x1, y1, x2, y2 = mark['search_window']
+    return dict(
+        mark,
+        position=[mark['position'][0] * scale_x, mark['position'][1] * scale_y],
+        size=mark['size'] * min(scale_x, scale_y),
+        search_window=[int(x1 * scale_x), int(y1 * scale_y), int(x2 * scale_x), int(y2 * scale_y)]
+    )
+
+def _merge_overlapping(rects):
+    """Merge [x1, y1, x2, y2] rectangles until none of them overlap"""
+    rects = [list(r) for r in rects]
+    merged = True
+    while merged:
+        merged = False
+        out = []
+        for rect in rects:
+            for other in out:
+                if rect[0] < other[2] and other[0] < rect[2] and rect[1] < other[3] and other[1] < rect[3]:
+                    other[0] = min(other[0], rect[0])
+                    other[1] = min(other[1], rect[1])
+                    other[2] = max(other[2], rect[2])
+                    other[3] = max(other[3], rect[3])
+                    merged = True
+                    break
+            else:
+                out.append(rect)
+        rects = out
+    return rects
+
+def compile_template(position_data):
+    """
+    Return a CompiledTemplate for a positions dict, a bare bubble_positions
+    list or an already compiled template
+    """
+    if isinstance(position_data, CompiledTemplate):
+        return position_data
+    if isinstance(position_data, dict):
+        return CompiledTemplate.from_position_data(position_data)
+    return CompiledTemplate.from_bubble_positions(position_data)
+
+def compile_pages(position_data):
+    """
+    One CompiledTemplate per page of a positions dict: the pages of a
+    multi-page layout ({'pages': [...]}), or the single page of any other.
+    Question numbers stay global, so every page scores against the full key.
+    A list of compiled pages (see load_pages) is returned as is.
+    """
+    if isinstance(position_data, dict) and 'pages' in position_data:
+        return [CompiledTemplate.from_position_data(page) for page in position_data['pages']]
+    if isinstance(position_data, list) and position_data and isinstance(position_data[0], CompiledTemplate):
+        return list(position_data)
+    return [compile_template(position_data)]
+
+def page_for_code(pages, code):
+    """The page of a multi-page layout that prints this layout code"""
+    for template in pages:
+        if template.layout_code == code:
+            return template
+    raise ValueError(f"Layout code {code} is not one of the layout's {len(pages)} pages")
+
+def encode_layout_code(code):
+    """Bits printed for a layout code: start bit, code bits, even parity"""
+    if not 0 <= code < 2 ** LAYOUT_CODE_BITS:
+        raise ValueError(f"Layout code must fit in {LAYOUT_CODE_BITS} bits, got {code}")
+    bits = [(code >> shift) & 1 for shift in range(LAYOUT_CODE_BITS - 1, -1, -1)]
+    return [1] + bits + [sum(bits) % 2]
+
+def decode_layout_code(bits):
+    """The code behind bits read off a page, or None when they do not check out"""
+    bits = [int(bool(b)) for b in bits]
+    if len(bits) != LAYOUT_CODE_BITS + 2 or bits[0] != 1 or sum(bits[1:-1]) % 2 != bits[-1]:
+        return None
+    code = 0
+    for bit in bits[1:-1]:
+        code = (code << 1) | bit
+    return code
+
+def _aligned(offset):
+    return -(-offset // _ALIGN) * _ALIGN
+
+def _json_default(value):
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def is_binary_template(path):
+    """True for a file written by save_templates, checked by its magic bytes"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(TEMPLATE_MAGIC)) == TEMPLATE_MAGIC
+    except OSError:
+        return False
+
+def save_templates(path, templates):
+    """
+    Write compiled templates (the pages of one layout) to a compact binary
+    file: a small JSON header with the scalar layout data, then the raw
+    bubble arrays, so load_templates can map them without parsing.
+    The file is written next to path and moved over it, so processes that
+    have the old file mapped keep reading it whole.
+    """
+    arrays = []
+    data_size = 0
+
+    def describe(template):
+        nonlocal data_size
+        meta = {
+            'choices': list(template.choices),
+            'page_size': template.page_size,
+            'margin': template.margin,
+            'bubble_diameter': template.bubble_diameter,
+            'reference_marks': template.reference_marks,
+            'version': template.version,
+            'layout_code': template.layout_code,
+            'arrays': {},
+            'fields': {name: describe(field) for name, field in template.fields.items()}
+        }
+        for name in TEMPLATE_ARRAYS:
+            array = np.ascontiguousarray(getattr(template, name))
+            offset = _aligned(data_size)
+            meta['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            arrays.append((offset, array))
+            data_size = offset + array.nbytes
+        return meta
+
+    header = json.dumps({'pages': [describe(t) for t in templates]}, default=_json_default,
+                        separators=(',', ':')).encode('utf-8')
+    data_start = _aligned(len(TEMPLATE_MAGIC) + 8 + len(header))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(TEMPLATE_MAGIC + struct.pack('<Q', len(header)) + header)
+            for offset, array in arrays:
+                f.write(b"\0" * (data_start + offset - f.tell()))
+                f.write(array.tobytes())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return path
+
+def load_templates(path):
+    """
+    Map a binary template file and return its pages as CompiledTemplates.
+    The bubble arrays are read-only views of one memory map, so loading is
+    a header parse and processes grading from the same file share its
+    pages in the OS cache.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(TEMPLATE_MAGIC)) != TEMPLATE_MAGIC:
+            raise ValueError(f"{path} is not a binary template file")
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size))
+    data_start = _aligned(len(TEMPLATE_MAGIC) + 8 + header_size)
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+
+    def build(meta):
+        arrays = {}
+        for name, spec in meta['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            start = data_start + spec['offset']
+            count = int(np.prod(spec['shape']))
+            arrays[name] = buffer[start:start + count * dtype.itemsize].view(dtype).reshape(spec['shape'])
+        return CompiledTemplate(
+            arrays['bboxes'], arrays['centers'], arrays['choice_indices'], arrays['questions'], arrays['question_pos'],
+            meta['choices'],
+            page_size=meta['page_size'],
+            margin=meta['margin'],
+            bubble_diameter=meta['bubble_diameter'],
+            reference_marks=meta['reference_marks'],
+            fields={name: build(field) for name, field in meta['fields'].items()},
+            version=meta['version'],
+            layout_code=meta.get('layout_code')
+        )
+
+    mtime_ns = os.stat(path).st_mtime_ns
+    pages = []
+    for page, meta in enumerate(header['pages']):
+        template = build(meta)
+        template._source = (os.path.abspath(path), page, mtime_ns)
+        pages.append(template)
+    return pages
+
+@lru_cache(maxsize=64)
+def _load_mapped_page(path, page, mtime_ns=None):
+    # mtime_ns only keys the cache, so a file replaced since is mapped again
+    return load_templates(path)[page]
+
+def load_pages(path):
+    """Every page of a positions JSON or binary template file, compiled"""
+    if is_binary_template(path):
+        return load_templates(path)
+    with open(path, 'r') as f:
+        return compile_pages(json.load(f))
+
+def pages_to_position_data(templates):
+    """JSON export of compiled pages: one positions dict, or {'pages': [...]}"""
+    if len(templates) == 1:
+        return templates[0].to_position_data()
+    pages = []
+    for page, template in enumerate(templates):
+        page_data = template.to_position_data()
+        page_data['page'] = page + 1
+        pages.append(page_data)
+    return {'pages': pages, 'num_questions': sum(t.num_questions for t in templates)}
+
+if __name__ == "__main__":
+    # Convert between *_positions.json and binary .tpl templates
+    if len(sys.argv) != 3:
+        print("Usage: python compiled_template.py <input .json|.tpl> <output .json|.tpl>")
+        sys.exit(1)
+    source, target = sys.argv[1:]
+    pages = load_pages(source)
+    if target.lower().endswith(TEMPLATE_EXTENSION):
+        save_templates(target, pages)
+    else:
+        with open(target, 'w') as f:
+            json.dump(pages_to_position_data(pages), f, indent=2, default=_json_default)
+    print(f"Wrote {len(pages)} page(s) from {source} to {target} ({os.path.getsize(target)} bytes)")
@@ -0,0 +1,92 @@
+import os
+import cv2
+import numpy as np
+
+# Same colour scheme as the interactive debug window (BGR)
+COLOR_CORRECT = (0, 255, 0)
+COLOR_SHOULD_BE = (255, 0, 0)
+COLOR_WRONG = (0, 0, 255)
+COLOR_MULTI = (0, 165, 255)
+COLOR_EMPTY = (128, 128, 128)
+
+def _bubble_color(choice, student_answer, correct_answer, filled_ratio, threshold):
+    answered = student_answer not in ('MULTI', 'NONE')
+    if choice == correct_answer and choice == student_answer:
+        return COLOR_CORRECT
+    if choice == correct_answer and answered:
+        return COLOR_SHOULD_BE
+    if choice == student_answer and answered:
+        return COLOR_WRONG
+    if filled_ratio > threshold:
+        return COLOR_MULTI
+    return COLOR_EMPTY
+
+def render_question_strips(gray, template, fill_ratios, answers, expected_answers, threshold, question_indices):
+    """
+    Annotate only the given questions: each one is cropped from the scan
+    around its bubbles, coloured and labelled, and the crops are stacked
+    into one small BGR image. The rest of the page is never copied.
+    """
+    h, w = gray.shape[:2]
+    strips = []
+
+    for q_idx in question_indices:
+        boxes = template.bboxes[q_idx][template.choice_mask[q_idx]]
+        if not len(boxes):
+            continue
+        bubble_size = int((boxes[:, 2] - boxes[:, 0]).max())
+        pad = bubble_size
+
+        # Question label on the left, room for the ratio text above
+        x1 = max(0, int(min(boxes[:, 0].min(), template.question_pos[q_idx][0])) - pad // 2)
+        y1 = max(0, int(boxes[:, 1].min()) - pad)
+        x2 = min(w, int(boxes[:, 2].max()) + pad)
+        y2 = min(h, int(boxes[:, 3].max()) + pad // 2)
+        if x2 <= x1 or y2 <= y1:
+            continue
+
+        crop = cv2.cvtColor(gray[y1:y2, x1:x2], cv2.COLOR_GRAY2BGR)
+        q_num = int(template.questions[q_idx])
+        student_answer = answers[q_idx]
+        correct_answer = expected_answers[q_num-1]
+
+        for c_idx in np.nonzero(template.choice_mask[q_idx])[0]:
+            choice = template.choices[template.choice_indices[q_idx, c_idx]]
+            filled_ratio = float(fill_ratios[q_idx, c_idx])
+            color = _bubble_color(choice, student_answer, correct_answer, filled_ratio, threshold)
+            cx, cy = template.centers[q_idx, c_idx].tolist()
+            cx, cy = cx - x1, cy - y1
+
+            cv2.circle(crop, (cx, cy), bubble_size // 2 + 4, color, 2)
+            cv2.putText(crop, f"{filled_ratio:.2f}", (cx - bubble_size // 2 - 4, cy - bubble_size // 2 - 6),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.35, color, 1)
+
+        label = np.full((22, crop.shape[1], 3), 255, dtype=np.uint8)
+        label_color = COLOR_CORRECT if student_answer == correct_answer else COLOR_WRONG
+        cv2.putText(label, f"Q{q_num:02d}: Student={student_answer}, Correct={correct_answer}",
+                    (4, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.45, label_color, 1)
+        strips.append(np.vstack([label, crop]))
+
+    if not strips:
+        return None
+
+    width = max(strip.shape[1] for strip in strips)
+    padded = [cv2.copyMakeBorder(strip, 0, 2, 0, width - strip.shape[1], cv2.BORDER_CONSTANT, value=(255, 255, 255))
+              for strip in strips]
+    return np.vstack(padded)
+
+def debug_output_path(debug_output, image_path):
+    """A file path is used as given, anything else is treated as a directory"""
+    if os.path.splitext(debug_output)[1].lower() in ('.png', '.jpg', '.jpeg', '.bmp'):
+        return debug_output
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(debug_output, f"{stem}_debug.png")
+
+def write_debug_overlay(path, overlay):
+    """Write the overlay without ever opening a window"""
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    if not cv2.imwrite(path, overlay):
+        raise ValueError(f"Could not write debug image to {path}")
+    return path
@@ -0,0 +1,102 @@
+import os
+import json
+
+from compiled_template import compile_pages, load_pages, page_for_code
+from grade_it import read_field, CODE_MULTI
+
+def load_answer_key(answers):
+    """
+    Parse an answer key given inline ("A,B,C"), as a list, or as a path to
+    a file holding either a JSON list or comma/whitespace separated letters
+    """
+    if isinstance(answers, (list, tuple)):
+        return [str(a).upper() for a in answers]
+    if os.path.isfile(answers):
+        with open(answers, 'r') as f:
+            answers = f.read()
+        try:
+            return [str(a).upper() for a in json.loads(answers)]
+        except ValueError:
+            pass
+    return [a.upper() for a in answers.replace(',', ' ').split()]
+
+class KeyTable:
+    """
+    Layout and answer key of every version of a shuffled exam, compiled
+    once and shipped to the grader as a whole. Sheets are generated with
+    generate_gabarito_png_improved(version=...), which prints the version
+    as a solid bubble the grader reads before scoring.
+
+    versions maps a version id to (layout, expected_answers), the layout
+    being a positions dict, a compiled template or the pages of a
+    multi-page layout. All versions share the page format, so the version
+    field of any of them locates it; the first one that has the field is
+    used to read every sheet. Multi-page versions share the layout code of
+    each page, which picks the page before the version is read.
+    """
+
+    def __init__(self, versions):
+        if not versions:
+            raise ValueError("Key table has no versions")
+        self.versions = {v: (compile_pages(layout), list(answers)) for v, (layout, answers) in versions.items()}
+
+        self.reader = None
+        self.pages = None
+        for pages, _ in self.versions.values():
+            if 'version' in pages[0].fields:
+                self.reader = pages[0]
+                self.pages = pages
+                break
+        if self.reader is None:
+            raise ValueError("None of the key table layouts has a printed version field")
+
+    def read_version(self, gray, template, block_size):
+        """Version printed on a scan, read through a template fitted to it"""
+        field = template.fields.get('version')
+        if field is None:
+            raise ValueError("Template has no version field")
+        codes, _ = read_field(gray, field, block_size)
+        code = int(codes[0])
+        if code < 0:
+            found = "several versions" if code == CODE_MULTI else "no version"
+            raise ValueError(f"Could not read the exam version: {found} marked")
+        return field.choices[code]
+
+    def select(self, version, layout_code=None):
+        """
+        (template, expected_answers) for a version id; layout_code picks
+        the page of a multi-page layout
+        """
+        if version not in self.versions:
+            raise ValueError(f"Version {version!r} is not in the key table")
+        pages, answers = self.versions[version]
+        if len(pages) == 1:
+            return pages[0], answers
+        if layout_code is None:
+            raise ValueError(f"Version {version!r} spans {len(pages)} pages; give the layout code of the page")
+        return page_for_code(pages, layout_code), answers
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a JSON table mapping each version to its positions file and key:
+
+            {"A": {"positions": "exam_A_positions.json", "answers": "A,B,C,..."},
+             "B": {"positions": "exam_B_positions.json", "answers": "key_B.txt"}}
+
+        Relative paths are resolved against the table's own folder.
+        """
+        folder = os.path.dirname(os.path.abspath(path))
+        with open(path, 'r') as f:
+            table = json.load(f)
+
+        def resolve(p):
+            return p if os.path.isabs(p) else os.path.join(folder, p)
+
+        versions = {}
+        for version, entry in table.items():
+            answers = entry['answers']
+            if isinstance(answers, str) and os.path.isfile(resolve(answers)):
+                answers = resolve(answers)
+            versions[version] = (load_pages(resolve(entry['positions'])), load_answer_key(answers))
+        return cls(versions)
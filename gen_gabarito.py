@@ -5,207 +5,723 @@ from PIL import Image, ImageDraw, ImageFont
 import math
 import json
 import os
+import re
+import zlib
+from functools import lru_cache
 
-print(f"OpenCV version: {cv2.__version__}")
-print(f"Pillow version: {Image.__version__}")
-print(f"NumPy version: {np.__version__}")
+from compiled_template import (mark_search_window, compile_pages, save_templates, encode_layout_code,
+                               MARK_SEARCH_REACH, REFERENCE_MARK_SIZE, SIDE_TICK_SIZE, HEADER_HEIGHT,
+                               TEMPLATE_EXTENSION, LAYOUT_CODE_BITS)
 
-def generate_gabarito_png_improved(
-    filename="gabarito.png",
-    num_questions=50,
-    choices=("A", "B", "C", "D", "E"),
-    margin=50,
-    spacing_y=20,
-    bubble_diameter=20,
-    title="GABARITO FIXO",
-    subtitle="Nome: _________________________   Numero: ____   Turma: ______",
-    font_path=None,
-    add_reference_marks=True
-):
+FONT_CANDIDATES = [
+    "arial.ttf",
+    "Arial.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/Library/Fonts/Arial.ttf",
+    "C:/Windows/Fonts/arial.ttf"
+]
+
+FONT_SIZES = {'title': 60, 'subtitle': 24, 'question': 28, 'choice': 28, 'header': 20}
+
+FOOTER_TEXT = "Assinale apenas uma opção por questão. Use caneta preta ou azul."
+
+# Layout coordinates are pixels at LAYOUT_DPI; render(dpi=...) rasterizes
+# the same layout at the print resolution
+LAYOUT_DPI = 150
+
+# Paper formats in millimetres (short side, long side)
+PAPER_SIZES = {
+    'A3': (297, 420),
+    'A4': (210, 297),
+    'A5': (148, 210),
+    'letter': (215.9, 279.4),
+    'legal': (215.9, 355.6)
+}
+
+# Page used when no paper format is given (about A5 landscape)
+DEFAULT_PAGE_SIZE = (1240, 877)
+
+# Gap between the reference-mark frame and the rows printed just inside it
+MARK_CLEARANCE = 10
+
+# Distance between the subtitle and footer lines
+FOOTER_LINE_PITCH = 25
+
+# Horizontal gap between the last bubble of a column and the next column
+COLUMN_GAP = 20
+
+# Layout code squares under the footer, inside the bottom marks and clear
+# of their search windows
+LAYOUT_CODE_SQUARE = 14
+LAYOUT_CODE_PITCH = 20
+
+# Scratch surface for text measurements
+_MEASURE = ImageDraw.Draw(Image.new("L", (1, 1)))
+
+@lru_cache(maxsize=None)
+def load_fonts(font_path=None, scale=1.0):
+    """
+    The generator's fonts by role, loaded once per font path and scale.
+    Without a path the common system fonts are probed, then Pillow's
+    default font.
+    """
     try:
-        # Try to find a common font
         if font_path is None:
-            # Common font paths for different systems
-            possible_fonts = [
-                "arial.ttf",
-                "Arial.ttf",
-                "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-                "/Library/Fonts/Arial.ttf",
-                "C:/Windows/Fonts/arial.ttf"
-            ]
-            
-            for font in possible_fonts:
-                if os.path.exists(font):
-                    font_path = font
-                    break
-            else:
-                font_path = None
-        
+            font_path = next((font for font in FONT_CANDIDATES if os.path.exists(font)), None)
         if font_path:
-            title_font = ImageFont.truetype(font_path, 60) 
-            subtitle_font = ImageFont.truetype(font_path, 24)
-            q_font = ImageFont.truetype(font_path, 28)
-            choice_font = ImageFont.truetype(font_path, 28)
-            header_font = ImageFont.truetype(font_path, 20)
-        else:
-            title_font = ImageFont.load_default()
-            subtitle_font = ImageFont.load_default()
-            q_font = ImageFont.load_default()
-            choice_font = ImageFont.load_default()
-            header_font = ImageFont.load_default()
+            return {role: ImageFont.truetype(font_path, round(size * scale)) for role, size in FONT_SIZES.items()}
     except Exception as e:
         print(f"Font warning: {e}, using default fonts")
-        title_font = ImageFont.load_default()
-        subtitle_font = ImageFont.load_default()
-        q_font = ImageFont.load_default()
-        choice_font = ImageFont.load_default()
-        header_font = ImageFont.load_default()
-
-    if num_questions > 10:
-        columns = num_questions // 10
-    else:
-        columns = 1
+    return {role: ImageFont.load_default() for role in FONT_SIZES}
 
-    rows_per_col = math.ceil(num_questions / columns)
-    estimated_row_height = spacing_y + bubble_diameter
+@lru_cache(maxsize=4096)
+def text_bbox(font, text):
+    """draw.textbbox((0, 0), text) for a cached font, remembered per string"""
+    return _MEASURE.textbbox((0, 0), text, font=font)
 
-    header_height = 40
-    required_height = int(margin * 2 + header_height + 10 + rows_per_col * estimated_row_height + 50)
+def wrap_text(font, text, width):
+    """
+    Lines of text no wider than width pixels, broken between words and
+    never inside a "Label: ____" blank. Raises ValueError when a single
+    word is wider.
+    """
+    lines = []
+    line = ""
+    for word in re.findall(r"\s*\S+(?::\s*_+)?", text):
+        if line and text_bbox(font, line + word)[2] > width:
+            lines.append(line)
+            line = word.lstrip()
+        else:
+            line += word
+    lines.append(line.lstrip())
+    for line in lines:
+        if text_bbox(font, line)[2] > width:
+            raise ValueError(f"{line!r} does not fit the {width} px between the reference marks")
+    return lines
 
-    calculated_width = 300 * columns
-    page_size = (1240, 877)
+def paper_page_size(paper=None, orientation="landscape"):
+    """
+    Page size in layout pixels for a paper format name ('A4', 'letter',
+    ...) or a (width_mm, height_mm) pair. None gives DEFAULT_PAGE_SIZE.
+    """
+    if paper is None:
+        return DEFAULT_PAGE_SIZE
+    if isinstance(paper, str):
+        sizes = {name.lower(): size for name, size in PAPER_SIZES.items()}
+        if paper.lower() not in sizes:
+            raise ValueError(f"Unknown paper format {paper!r}, expected one of {list(PAPER_SIZES)}")
+        paper = sizes[paper.lower()]
+    if orientation not in ("landscape", "portrait"):
+        raise ValueError(f"Orientation must be 'landscape' or 'portrait', got {orientation!r}")
+    short_mm, long_mm = sorted(paper)
+    width_mm, height_mm = (long_mm, short_mm) if orientation == "landscape" else (short_mm, long_mm)
+    return (round(width_mm / 25.4 * LAYOUT_DPI), round(height_mm / 25.4 * LAYOUT_DPI))
 
-    img = Image.new("RGB", page_size, "white")
-    draw = ImageDraw.Draw(img)
+def _scale_coords(value, scale):
+    """Multiply every number in a point, box or list of points"""
+    if isinstance(value, (list, tuple)):
+        return type(value)(_scale_coords(v, scale) for v in value)
+    return value * scale
 
-    w, h = page_size
+class SheetLayout:
+    """
+    Full geometry of one answer sheet configuration, computed once: the
+    drawing operations of the blank pages, the bubble positions and the
+    spots where per-student fields are stamped. Get one through
+    get_layout() so the same configuration is only laid out once, then
+    render() as many variants as needed:
 
-    # Get text dimensions for centering
-    title_bbox = draw.textbbox((0, 0), title, font=title_font)
-    title_width = title_bbox[2] - title_bbox[0]
-    title_x = (w - title_width) // 2
-    
-    draw.text((title_x, margin//2), title, font=title_font, fill="black")
-    top = margin + 15 + header_height
-    bottom = h - margin
-    usable_height = bottom - top
-    col_width = (w - 2*margin) / columns
-    row_height = min(spacing_y + bubble_diameter, usable_height / rows_per_col)
-
-    bubble_positions = []
-
-    q = 1
-    for col in range(columns):
-        x0 = margin + col * col_width
-        x_question_num = x0 + 20
-        temp_bbox = draw.textbbox((0,0), f"{q:02d}.", font=q_font)
-        q_text_width = temp_bbox[2] - temp_bbox[0]
-        x_choices_start = x_question_num + q_text_width + 30
-
-        header_y = margin + 15
-        for i, ch in enumerate(choices):
-            cx = int(x_choices_start + i * (bubble_diameter + 20))
-            bbox = draw.textbbox((0, 0), ch, font=header_font)
-            w_ch = bbox[2] - bbox[0]
-            h_ch = bbox[3] - bbox[1]
-            tx = cx + (bubble_diameter - w_ch) / 2
-            ty = header_y
-            draw.text((tx, ty), ch, font=header_font, fill="black")
-
-            line_y_start = ty + h_ch + 2
-            line_y_end = top - 5
-            if line_y_end > line_y_start:
-                draw.line([(cx + bubble_diameter//2, line_y_start),
-                          (cx + bubble_diameter//2, line_y_end)],
-                         fill="black", width=1)
-
-        for row in range(rows_per_col):
-            if q > num_questions:
-                break
-            y = int(top + row * row_height)
-            draw.text((x_question_num, y), f"{q:02d}.", font=q_font, fill="black")
-
-            question_bubbles = []
-            for i, ch in enumerate(choices):
-                cx = int(x_choices_start + i * (bubble_diameter + 20))
-                cy = int(y + (bubble_diameter/4) - bubble_diameter/2)
-
-                # Draw bubble WITHOUT letter inside (clean for marking)
-                draw.ellipse([cx, cy, cx + bubble_diameter, cy + bubble_diameter],
-                           outline="black", width=2)
-
-                # Store position for reference
-                question_bubbles.append({
-                    'choice': ch,
-                    'center': (cx + bubble_diameter//2, cy + bubble_diameter//2),
-                    'bbox': (cx, cy, cx + bubble_diameter, cy + bubble_diameter),
-                    'header_pos': (cx + bubble_diameter//2, header_y)
-                })
+        layout = get_layout(num_questions=30, versions=("A", "B"), student_id_digits=6)
+        for student in roster:
+            img = layout.render(version="B", student_id="123456", fields={"Nome": "Ana"})
 
-            bubble_positions.append({
-                'question': q,
-                'bubbles': question_bubbles,
-                'question_pos': (x_question_num, y)
-            })
-            q += 1
+    Each page carries its layout code as a row of squares under the
+    footer (filled for 1 bits): a hash of the title and page geometry
+    unless layout_code gives the first page's number, the next pages
+    counting up.
+
+    The page comes from a paper format (paper_page_size) and questions are
+    placed in as many columns as fit at their natural row height; when
+    they do not all fit, they continue on further pages. Every page
+    repeats the title, marks, version field and ID grid, so each one can
+    be graded on its own. Each blank page is drawn a single time per
+    resolution and copied for every variant, until release().
+    """
+
+    def __init__(self, num_questions=50, choices=("A", "B", "C", "D", "E"), margin=50, spacing_y=20,
+                 bubble_diameter=20, title="GABARITO FIXO",
+                 subtitle="Nome: _________________________   Numero: ____   Turma: ______",
+                 font_path=None, add_reference_marks=True, versions=None, student_id_digits=0,
+                 paper=None, orientation="landscape", layout_code=None):
+        self.num_questions = num_questions
+        self.choices = tuple(choices)
+        self.margin = margin
+        self.bubble_diameter = bubble_diameter
+        self.versions = tuple(versions) if versions else None
+        self.student_id_digits = student_id_digits
+        self.title = title
+        self.font_path = font_path
+        self.fonts = load_fonts(font_path)
+        self.page_size = paper_page_size(paper, orientation)
+
+        # ('text', xy, text, font role) / ('line', points, width) / ('ellipse', box, width) / ('rect', box, width)
+        # ops are drawn on every page, page_ops[i] only on page i
+        self.ops = []
+        self.page_ops = []
+        self.page_bubbles = []
+        self.reference_marks = []
+        self.fields = {}
+        self.field_slots = {}
+        self._blanks = {}
+        self._blank_scale = None
+
+        self.header_height = HEADER_HEIGHT
+        w = self.page_size[0]
+        title_bbox = text_bbox(self.fonts['title'], title)
+        if title_bbox[2] - title_bbox[0] > w - 2 * margin:
+            raise ValueError(f"Title {title!r} is wider than the {w - 2 * margin} px between the reference marks")
+        self.title_xy = ((w - (title_bbox[2] - title_bbox[0])) // 2, margin // 2)
+        self.title_box = (self.title_xy[0] + title_bbox[0], self.title_xy[1] + title_bbox[1],
+                          self.title_xy[0] + title_bbox[2], self.title_xy[1] + title_bbox[3])
+        # The version row sits just inside the top marks (or under the
+        # title); the choice headers move down below it
+        self.header_y = margin + 15
+        if self.versions:
+            self.version_y = self._place_version_row()
+            self.header_y = self._version_row_box(self.version_y)[3] + 8
+        self.top = self.header_y + self.header_height
+        # Footer band, bottom up from the bottom marks: the layout code
+        # row, the footer lines and the subtitle lines, wrapped to the
+        # width between the marks
+        subtitle_font = self.fonts['subtitle']
+        self.subtitle_lines = wrap_text(subtitle_font, subtitle, w - 2 * margin)
+        self.footer_lines = wrap_text(subtitle_font, FOOTER_TEXT, w - 2 * margin)
+        self.code_y = self.page_size[1] - margin - LAYOUT_CODE_SQUARE
+        self.footer_y = (self.code_y - 6 - text_bbox(subtitle_font, self.footer_lines[-1])[3]
+                         - FOOTER_LINE_PITCH * (len(self.footer_lines) - 1))
+        self.subtitle_y = self.footer_y - FOOTER_LINE_PITCH * len(self.subtitle_lines)
+        # Student ID grid: one column of 0-9 bubbles per digit on the right,
+        # kept clear of the side ticks' search windows
+        self.id_pitch = bubble_diameter + 6
+        self.id_right = self.page_size[0] - margin - MARK_SEARCH_REACH
+
+        self._layout_title(title)
+        self._layout_questions(spacing_y)
+        if add_reference_marks:
+            self._layout_reference_marks()
+        if self.versions:
+            self._layout_version()
+        if student_id_digits:
+            self._layout_student_id()
+        self._layout_codes(layout_code)
+        self._layout_footer()
+
+    @property
+    def num_pages(self):
+        return len(self.page_bubbles)
+
+    @property
+    def bubble_positions(self):
+        """Bubble positions of every page, in question order"""
+        return [q_data for page in self.page_bubbles for q_data in page]
+
+    def _text(self, xy, text, role, ops=None):
+        (self.ops if ops is None else ops).append(('text', xy, text, role))
+
+    def _layout_title(self, title):
+        self._text(self.title_xy, title, 'title')
+
+    def _version_row_box(self, y):
+        """Box of the version row (label, bubbles and letters) with its top at y"""
+        d = self.bubble_diameter
+        header_font = self.fonts['header']
+        label_bbox = text_bbox(header_font, "Versão")
+        x1 = self.margin + 60
+        x2 = x1 + label_bbox[2] - label_bbox[0] + 10 + len(self.versions) * (d + 10) - 10
+        letters = max(text_bbox(header_font, v)[3] for v in self.versions)
+        return (x1, y, x2, y + d + 2 + letters)
+
+    def _place_version_row(self):
+        """
+        Top of the version row: just inside the top marks, or under the
+        title when the two would overlap
+        """
+        w = self.page_size[0]
+        x1, y1, x2, y2 = self._version_row_box(self.margin + MARK_CLEARANCE)
+        if x2 > w - self.margin - MARK_SEARCH_REACH:
+            raise ValueError(f"{len(self.versions)} version bubbles do not fit a {w} px wide page")
+        tx1, ty1, tx2, ty2 = self.title_box
+        if x1 < tx2 and tx1 < x2 and y1 < ty2 and ty1 < y2:
+            return ty2 + MARK_CLEARANCE
+        return y1
+
+    def _question_grid(self, spacing_y):
+        """
+        (rows, columns) of questions that fit on one page without
+        shrinking the rows, and the width left for the question columns
+        """
+        w, _ = self.page_size
+        d = self.bubble_diameter
+        id_width = 30 + self.student_id_digits * self.id_pitch if self.student_id_digits else 0
+        available_width = w - 2*self.margin - (id_width + MARK_SEARCH_REACH if id_width else 0)
+        usable_height = self.subtitle_y - 10 - self.top
+
+        label_bbox = text_bbox(self.fonts['question'], f"{self.num_questions:02d}.")
+        column_width = 20 + (label_bbox[2] - label_bbox[0]) + 30 + len(self.choices) * (d + 20) - 20 + d + COLUMN_GAP
+        rows = int(usable_height // (spacing_y + d))
+        columns = int(available_width // column_width)
+        if rows < 1 or columns < 1:
+            raise ValueError(f"A {self.page_size[0]}x{self.page_size[1]} page has no room for a question column; "
+                             "use a larger paper format or fewer choices")
+        return rows, columns, available_width
+
+    def _layout_questions(self, spacing_y):
+        margin, d = self.margin, self.bubble_diameter
+        top = self.top
+        row_height = spacing_y + d
+        max_rows, max_columns, available_width = self._question_grid(spacing_y)
+
+        num_pages = max(1, math.ceil(self.num_questions / (max_rows * max_columns)))
+        per_page = math.ceil(self.num_questions / num_pages)
+
+        q = 1
+        for page in range(num_pages):
+            ops = []
+            bubble_positions = []
+            on_page = min(per_page, self.num_questions - q + 1)
+            columns = max(1, math.ceil(on_page / max_rows))
+            rows_per_col = math.ceil(on_page / columns)
+            col_width = available_width / columns
+            last = q + on_page - 1
+
+            for col in range(columns):
+                x0 = margin + col * col_width
+                x_question_num = x0 + 20
+                q_text_bbox = text_bbox(self.fonts['question'], f"{q:02d}.")
+                x_choices_start = x_question_num + (q_text_bbox[2] - q_text_bbox[0]) + 30
+
+                header_y = self.header_y
+                for i, ch in enumerate(self.choices):
+                    cx = int(x_choices_start + i * (d + 20))
+                    bbox = text_bbox(self.fonts['header'], ch)
+                    self._text((cx + (d - (bbox[2] - bbox[0])) / 2, header_y), ch, 'header', ops)
+
+                    line_y_start = header_y + (bbox[3] - bbox[1]) + 2
+                    line_y_end = top - 5
+                    if line_y_end > line_y_start:
+                        ops.append(('line', [(cx + d//2, line_y_start), (cx + d//2, line_y_end)], 1))
+
+                for row in range(rows_per_col):
+                    if q > last:
+                        break
+                    y = int(top + row * row_height)
+                    self._text((x_question_num, y), f"{q:02d}.", 'question', ops)
+
+                    question_bubbles = []
+                    for i, ch in enumerate(self.choices):
+                        cx = int(x_choices_start + i * (d + 20))
+                        cy = int(y + (d/4) - d/2)
+
+                        # Bubble WITHOUT letter inside (clean for marking)
+                        ops.append(('ellipse', [cx, cy, cx + d, cy + d], 2))
+                        question_bubbles.append({
+                            'choice': ch,
+                            'center': (cx + d//2, cy + d//2),
+                            'bbox': (cx, cy, cx + d, cy + d),
+                            'header_pos': (cx + d//2, header_y)
+                        })
+
+                    bubble_positions.append({
+                        'question': q,
+                        'bubbles': question_bubbles,
+                        'question_pos': (x_question_num, y)
+                    })
+                    q += 1
+
+            # Page number on the layout code row, clear of the bottom-right
+            # mark's search window
+            if num_pages > 1:
+                w = self.page_size[0]
+                label = f"{page + 1}/{num_pages}"
+                label_bbox = text_bbox(self.fonts['header'], label)
+                label_y = self.code_y + (LAYOUT_CODE_SQUARE - (label_bbox[3] + label_bbox[1])) // 2
+                self._text((w - margin - MARK_SEARCH_REACH - 15 - label_bbox[2], label_y), label, 'header', ops)
+
+            self.page_ops.append(ops)
+            self.page_bubbles.append(bubble_positions)
+
+    def _layout_reference_marks(self):
+        w, h = self.page_size
+        margin = self.margin
+        mark_size = REFERENCE_MARK_SIZE
+        half = mark_size / 2
+        marks = self.reference_marks
 
-    # Add reference marks for precise detection
-    if add_reference_marks:
-        mark_size = 15
         # Top-left: Cross pattern
-        draw.line([(margin, margin), (margin+mark_size, margin)], fill="black", width=3)
-        draw.line([(margin, margin), (margin, margin+mark_size)], fill="black", width=3)
-        
+        self.ops.append(('line', [(margin, margin), (margin+mark_size, margin)], 3))
+        self.ops.append(('line', [(margin, margin), (margin, margin+mark_size)], 3))
+        marks.append({'type': 'cross', 'position': (margin, margin), 'size': mark_size})
+
         # Top-right: L pattern
-        draw.line([(w-margin, margin), (w-margin-mark_size, margin)], fill="black", width=3)
-        draw.line([(w-margin, margin), (w-margin, margin+mark_size)], fill="black", width=3)
-        
+        self.ops.append(('line', [(w-margin, margin), (w-margin-mark_size, margin)], 3))
+        self.ops.append(('line', [(w-margin, margin), (w-margin, margin+mark_size)], 3))
+        marks.append({'type': 'L', 'position': (w-margin, margin), 'size': mark_size})
+
         # Bottom-left: Square pattern
-        draw.rectangle([(margin, h-margin-mark_size), (margin+mark_size, h-margin)],
-                      outline="black", width=3)
-        
+        self.ops.append(('rect', [(margin, h-margin-mark_size), (margin+mark_size, h-margin)], 3))
+        marks.append({'type': 'square', 'position': (margin+half, h-margin-half), 'size': mark_size})
+
         # Bottom-right: Circle pattern
-        draw.ellipse([(w-margin-mark_size, h-margin-mark_size), (w-margin, h-margin)],
-                    outline="black", width=3)
+        self.ops.append(('ellipse', [(w-margin-mark_size, h-margin-mark_size), (w-margin, h-margin)], 3))
+        marks.append({'type': 'circle', 'position': (w-margin-half, h-margin-half), 'size': mark_size})
 
-        # Add alignment marks along the sides
+        # Alignment marks along the sides
         for i in range(3):
-            y_mark = margin + header_height + (h - 2*margin - header_height) * (i+1) // 4
-            draw.line([(margin-15, y_mark), (margin-5, y_mark)], fill="black", width=2)
-            draw.line([(w-margin+5, y_mark), (w-margin+15, y_mark)], fill="black", width=2)
-
-    footer_text = "Assinale apenas uma opção por questão. Use caneta preta ou azul."
-    bbox = draw.textbbox((0, 0), footer_text, font=subtitle_font)
-    fw = bbox[2] - bbox[0]
-    fh = bbox[3] - bbox[1]
-
-    subtitle_bbox = draw.textbbox((0, 0), subtitle, font=subtitle_font)
-    subtitle_width = subtitle_bbox[2] - subtitle_bbox[0]
-    subtitle_x = (w - subtitle_width) // 2
-    
-    draw.text((subtitle_x, h - margin - 40), subtitle, font=subtitle_font, fill="black")
-    draw.text((subtitle_x, h - margin - 15), footer_text, font=subtitle_font, fill="black")
+            y_mark = margin + self.header_height + (h - 2*margin - self.header_height) * (i+1) // 4
+            self.ops.append(('line', [(margin-15, y_mark), (margin-5, y_mark)], 2))
+            self.ops.append(('line', [(w-margin+5, y_mark), (w-margin+15, y_mark)], 2))
+            marks.append({'type': 'tick', 'position': (margin-10, y_mark), 'size': SIDE_TICK_SIZE})
+            marks.append({'type': 'tick', 'position': (w-margin+10, y_mark), 'size': SIDE_TICK_SIZE})
+
+        # Where the grader should look for each mark (anchor is the corner
+        # point for cross/L, the centre for the others)
+        for mark in marks:
+            mark['search_window'] = mark_search_window(mark['position'])
+
+    def _layout_version(self):
+        """
+        Exam version: one printed row of bubbles in the top-left corner,
+        inside the reference marks. render(version=...) prints that
+        version's bubble solid so the grader can read it.
+        """
+        d = self.bubble_diameter
+        header_font = self.fonts['header']
+        label = "Versão"
+        label_bbox = text_bbox(header_font, label)
+        vx = self.margin + 60
+        vy = self.version_y
+        self._text((vx, vy + (d - (label_bbox[3] - label_bbox[1])) // 2 - label_bbox[1]), label, 'header')
+        vx += label_bbox[2] - label_bbox[0] + 10
+
+        version_bubbles = []
+        for i, v in enumerate(self.versions):
+            cx = vx + i * (d + 10)
+            self.ops.append(('ellipse', [cx, vy, cx + d, vy + d], 2))
+            letter_bbox = text_bbox(header_font, v)
+            self._text((cx + (d - (letter_bbox[2] - letter_bbox[0])) / 2, vy + d + 2), v, 'header')
+            version_bubbles.append({
+                'choice': v,
+                'center': (cx + d//2, vy + d//2),
+                'bbox': (cx, vy, cx + d, vy + d)
+            })
+        self.fields['version'] = {
+            'choices': list(self.versions),
+            'bubble_positions': [{'question': 1, 'bubbles': version_bubbles}]
+        }
+
+    def _layout_student_id(self):
+        d = self.bubble_diameter
+        top = self.top
+        digits = self.student_id_digits
+        header_font = self.fonts['header']
+        id_x0 = self.id_right - digits * self.id_pitch
+
+        label = "Matrícula"
+        label_bbox = text_bbox(header_font, label)
+        label_x = id_x0 + (digits * self.id_pitch - (label_bbox[2] - label_bbox[0])) / 2
+        self._text((label_x, top - 30 - d), label, 'header')
+
+        digit_columns = []
+        digit_boxes = []
+        for column in range(digits):
+            cx = id_x0 + column * self.id_pitch
+            # Box above each column for the handwritten digit
+            box = [cx - 2, top - 8 - d, cx + d + 2, top - 6]
+            self.ops.append(('rect', box, 1))
+            digit_boxes.append(box)
+            digit_bubbles = []
+            for digit in range(10):
+                cy = top + digit * self.id_pitch
+                self.ops.append(('ellipse', [cx, cy, cx + d, cy + d], 2))
+                digit_bubbles.append({
+                    'choice': str(digit),
+                    'center': (cx + d//2, cy + d//2),
+                    'bbox': (cx, cy, cx + d, cy + d)
+                })
+            digit_columns.append({'question': column + 1, 'bubbles': digit_bubbles})
+
+        for digit in range(10):
+            bbox = text_bbox(header_font, str(digit))
+            self._text((id_x0 - 20, top + digit * self.id_pitch + (d - (bbox[3] - bbox[1])) / 2 - bbox[1]),
+                       str(digit), 'header')
+
+        self.digit_boxes = digit_boxes
+        self.fields['student_id'] = {
+            'choices': [str(digit) for digit in range(10)],
+            'bubble_positions': digit_columns
+        }
+
+    def _page_code(self, page):
+        """16-bit hash of the title and a page's bubble geometry and printed fields"""
+        geometry = [self.title, self.page_size, self.choices, sorted(self.fields),
+                    [(q['question'], [b['center'] for b in q['bubbles']]) for q in self.page_bubbles[page]]]
+        return zlib.crc32(json.dumps(geometry).encode()) % 2 ** LAYOUT_CODE_BITS
+
+    def _layout_codes(self, first_code=None):
+        s = LAYOUT_CODE_SQUARE
+        x0 = self.margin + 60
+        y0 = self.code_y
+        self.page_codes = []
+        self.page_code_fields = []
+        for page, ops in enumerate(self.page_ops):
+            code = self._page_code(page) if first_code is None else (first_code + page) % 2 ** LAYOUT_CODE_BITS
+            squares = []
+            for i, bit in enumerate(encode_layout_code(code)):
+                x = x0 + i * LAYOUT_CODE_PITCH
+                box = [x, y0, x + s, y0 + s]
+                ops.append(('fill', box) if bit else ('rect', box, 2))
+                squares.append({'question': i + 1, 'bubbles': [
+                    {'choice': '1', 'center': (x + s//2, y0 + s//2), 'bbox': (x, y0, x + s, y0 + s)}]})
+            self.page_codes.append(code)
+            self.page_code_fields.append({'choices': ['1'], 'bubble_diameter': s, 'bubble_positions': squares})
+
+    def _layout_footer(self):
+        w, _ = self.page_size
+        subtitle_font = self.fonts['subtitle']
+        # Subtitle and footer lines share one left edge, the widest centred
+        widest = max(text_bbox(subtitle_font, line)[2] for line in self.subtitle_lines + self.footer_lines)
+        x = (w - widest) // 2
+
+        for i, line in enumerate(self.subtitle_lines):
+            y = self.subtitle_y + i * FOOTER_LINE_PITCH
+            self._text((x, y), line, 'subtitle')
+            # "Label: ____" blanks in the subtitle, where render() can write
+            # the student's details
+            for match in re.finditer(r"(\w+):\s*(_+)", line):
+                start_bbox = text_bbox(subtitle_font, line[:match.start(2)])
+                self.field_slots[match.group(1).lower()] = (x + start_bbox[2] + 4, y - 6)
+        for i, line in enumerate(self.footer_lines):
+            self._text((x, self.footer_y + i * FOOTER_LINE_PITCH), line, 'subtitle')
+
+    def _draw_ops(self, draw, ops, scale):
+        fonts = load_fonts(self.font_path, scale)
+        for op in ops:
+            kind = op[0]
+            coords = op[1] if scale == 1 else _scale_coords(op[1], scale)
+            if kind == 'text':
+                draw.text(coords, op[2], font=fonts[op[3]], fill="black")
+                continue
+            if kind == 'fill':
+                draw.rectangle(coords, fill="black")
+                continue
+            width = op[2] if scale == 1 else max(1, round(op[2] * scale))
+            if kind == 'line':
+                draw.line(coords, fill="black", width=width)
+            elif kind == 'ellipse':
+                draw.ellipse(coords, outline="black", width=width)
+            else:
+                draw.rectangle(coords, outline="black", width=width)
+
+    def _scale(self, dpi):
+        return 1 if dpi is None else dpi / LAYOUT_DPI
+
+    def blank(self, page=0, dpi=None, keep=True):
+        """
+        A blank grayscale page, drawn on first use and shared afterwards
+        (do not modify). dpi rasterizes the layout at a print resolution
+        instead of the layout's own LAYOUT_DPI pixels. Only the pages of
+        the last resolution kept are held; keep=False draws a page for a
+        one-off render without holding it, and release() drops them all.
+        """
+        if not 0 <= page < self.num_pages:
+            raise ValueError(f"Layout has {self.num_pages} pages, no page {page + 1}")
+        scale = self._scale(dpi)
+        if scale == self._blank_scale and page in self._blanks:
+            return self._blanks[page]
 
-    img.save(filename, dpi=(300,300))
+        size = (round(self.page_size[0] * scale), round(self.page_size[1] * scale))
+        img = Image.new("L", size, "white")
+        draw = ImageDraw.Draw(img)
+        self._draw_ops(draw, self.ops, scale)
+        self._draw_ops(draw, self.page_ops[page], scale)
+        if keep:
+            if scale != self._blank_scale:
+                self._blanks = {}
+                self._blank_scale = scale
+            self._blanks[page] = img
+        return img
 
-    # Save bubble positions
-    position_data = {
-        'bubble_positions': bubble_positions,
-        'page_size': page_size,
-        'margin': margin,
-        'bubble_diameter': bubble_diameter,
-        'choices': choices
-    }
+    def release(self):
+        """Drop the blank pages kept by blank(); the geometry stays"""
+        self._blanks = {}
+        self._blank_scale = None
 
-    with open(filename.replace('.png', '_positions.json'), 'w') as f:
-        json.dump(position_data, f, indent=2)
+    def render(self, version=None, student_id=None, fields=None, page=0, dpi=None, keep_blank=True):
+        """
+        A copy of a blank page with the per-student parts stamped on:
+        the version bubble printed solid, the student ID written in its
+        boxes with its bubbles pre-filled, and `fields` ({"Nome": ...})
+        written on the matching subtitle blanks. keep_blank=False is for
+        a single render: the blank is drawn for it and not kept.
+        """
+        img = self.blank(page, dpi, keep_blank)
+        if keep_blank:
+            img = img.copy()
+        self.stamp(img, version, student_id, fields)
+        return img
 
-    return filename, position_data
+    def stamp(self, img, version=None, student_id=None, fields=None):
+        """Draw the per-student parts (see render) onto a page of this layout"""
+        draw = ImageDraw.Draw(img)
+        scale = img.size[0] / self.page_size[0]
+        fonts = load_fonts(self.font_path, scale) if scale != 1 else self.fonts
+        width = max(1, round(2 * scale))
+
+        if version is not None:
+            if not self.versions or version not in self.versions:
+                raise ValueError(f"Version {version!r} is not one of {list(self.versions or ())}")
+            row = self.fields['version']['bubble_positions'][0]['bubbles']
+            draw.ellipse(_scale_coords(row[self.versions.index(version)]['bbox'], scale),
+                         outline="black", fill="black", width=width)
+
+        if student_id is not None:
+            student_id = str(student_id)
+            columns = self.fields.get('student_id', {}).get('bubble_positions', [])
+            if len(student_id) > len(columns) or not student_id.isdigit():
+                raise ValueError(f"Student ID {student_id!r} does not fit the sheet's {len(columns)} digit columns")
+            for column, box, digit in zip(columns, self.digit_boxes, student_id):
+                draw.ellipse(_scale_coords(column['bubbles'][int(digit)]['bbox'], scale),
+                             outline="black", fill="black", width=width)
+                x1, y1, x2, y2 = _scale_coords(box, scale)
+                bbox = text_bbox(fonts['header'], digit)
+                draw.text((x1 + (x2 - x1 - (bbox[2] - bbox[0])) / 2 - bbox[0],
+                           y1 + (y2 - y1 - (bbox[3] - bbox[1])) / 2 - bbox[1]),
+                          digit, font=fonts['header'], fill="black")
+
+        for label, value in (fields or {}).items():
+            slot = self.field_slots.get(label.lower())
+            if slot is None:
+                raise ValueError(f"The subtitle has no '{label}:' blank")
+            draw.text(_scale_coords(slot, scale), str(value), font=fonts['subtitle'], fill="black")
+        return img
+
+    def page_position_data(self, page=0, version=None):
+        """The positions dict of one page, as saved for a single-page sheet"""
+        position_data = {
+            'bubble_positions': self.page_bubbles[page],
+            'page_size': self.page_size,
+            'margin': self.margin,
+            'bubble_diameter': self.bubble_diameter,
+            'choices': self.choices,
+            'reference_marks': self.reference_marks
+        }
+        if version is not None:
+            position_data['version'] = version
+        position_data['layout_code'] = self.page_codes[page]
+        position_data['fields'] = dict(self.fields, layout_code=self.page_code_fields[page])
+        return position_data
+
+    def position_data(self, version=None):
+        """
+        The *_positions.json content for sheets rendered with this version.
+        A multi-page layout gives {'pages': [...], ...} holding one
+        complete single-page dict per page, each with its 'page' number.
+        """
+        if self.num_pages == 1:
+            return self.page_position_data(0, version)
+        pages = []
+        for page in range(self.num_pages):
+            page_data = self.page_position_data(page, version)
+            page_data['page'] = page + 1
+            pages.append(page_data)
+        position_data = {
+            'pages': pages,
+            'num_questions': self.num_questions,
+            'page_size': self.page_size,
+            'choices': self.choices
+        }
+        if version is not None:
+            position_data['version'] = version
+        return position_data
+
+@lru_cache(maxsize=32)
+def get_layout(num_questions=50, choices=("A", "B", "C", "D", "E"), margin=50, spacing_y=20, bubble_diameter=20,
+               title="GABARITO FIXO", subtitle="Nome: _________________________   Numero: ____   Turma: ______",
+               font_path=None, add_reference_marks=True, versions=None, student_id_digits=0,
+               paper=None, orientation="landscape", layout_code=None):
+    """
+    SheetLayout for a configuration, laid out once and reused (arguments
+    must be hashable). Callers that keep blank pages release() them when
+    done, so the cached layouts only hold their geometry.
+    """
+    return SheetLayout(num_questions, choices, margin, spacing_y, bubble_diameter, title, subtitle,
+                       font_path, add_reference_marks, versions, student_id_digits, paper, orientation,
+                       layout_code)
+
+def page_filename(filename, page):
+    """Image name of one page of a multi-page sheet, e.g. gabarito_p0002.png"""
+    root, ext = os.path.splitext(filename)
+    return f"{root}_p{page + 1:04d}{ext}"
+
+def generate_gabarito_png_improved(
+    filename="gabarito.png",
+    num_questions=50,
+    choices=("A", "B", "C", "D", "E"),
+    margin=50,
+    spacing_y=20,
+    bubble_diameter=20,
+    title="GABARITO FIXO",
+    subtitle="Nome: _________________________   Numero: ____   Turma: ______",
+    font_path=None,
+    add_reference_marks=True,
+    version=None,
+    versions=("A", "B", "C", "D"),
+    student_id_digits=0,
+    paper=None,
+    orientation="landscape",
+    dpi=None,
+    positions_format="json",
+    layout_code=None
+):
+    """
+    Write a blank answer sheet PNG and its *_positions.json, and return
+    (list of PNG names, position data).
+    version prints the version field with that version marked;
+    student_id_digits adds a student ID grid with that many columns.
+    paper ('A4', 'letter', ...) sets the page, dpi the print resolution.
+    When the questions need more than one page, one PNG per page is
+    written (gabarito_p0001.png, ...).
+    positions_format="binary" writes a compact *_positions.tpl (see
+    compiled_template.save_templates) instead of the JSON file.
+    layout_code sets the number printed to identify the sheet (see
+    SheetLayout); by default it is derived from the title and layout.
+    """
+    if version is not None and version not in versions:
+        raise ValueError(f"Version {version!r} is not one of {list(versions)}")
+    if positions_format not in ("json", "binary"):
+        raise ValueError(f"Unknown positions format: {positions_format}")
+
+    layout = get_layout(num_questions, tuple(choices), margin, spacing_y, bubble_diameter, title, subtitle,
+                        font_path, add_reference_marks, tuple(versions) if version is not None else None,
+                        student_id_digits, paper, orientation, layout_code)
+    filenames = [filename] if layout.num_pages == 1 else [page_filename(filename, p) for p in range(layout.num_pages)]
+    for page, page_file in enumerate(filenames):
+        img = layout.render(version=version, page=page, dpi=dpi, keep_blank=False)
+        img.save(page_file, dpi=(dpi or LAYOUT_DPI,) * 2)
+
+    position_data = layout.position_data(version)
+    if positions_format == "binary":
+        save_templates(filename.replace('.png', '_positions' + TEMPLATE_EXTENSION), compile_pages(position_data))
+    else:
+        with open(filename.replace('.png', '_positions.json'), 'w') as f:
+            json.dump(position_data, f, indent=2)
+
+    return filenames, position_data
 
 def demonstrate_improved_layout():
 
     """Generate and display the improved layout"""
-    template_path, position_data = generate_gabarito_png_improved(
+    template_paths, position_data = generate_gabarito_png_improved(
         "./templates/gabarito_demo.png", 
         num_questions=15,
         add_reference_marks=True
@@ -215,15 +731,21 @@ def demonstrate_improved_layout():
     print("- Choice headers above bubbles")
     print("- Better spacing between question numbers and bubbles")
     print("- Reference marks for alignment")
-    print(f"- Saved positions to: {template_path.replace('.png', '_positions.json')}")
+    print(f"- Saved positions to: {template_paths[0].replace('.png', '_positions.json')}")
     
     # Display the image
-    img = Image.open(template_path)
+    img = Image.open(template_paths[0])
     print(f"\nTemplate size: {img.size}")
     
-    return template_path, position_data
+    return template_paths[0], position_data
+
+if __name__ == "__main__":
+    print(f"OpenCV version: {cv2.__version__}")
+    print(f"Pillow version: {Image.__version__}")
+    print(f"NumPy version: {np.__version__}")
+
+    # Gen
+    template_path, position_data = demonstrate_improved_layout()
 
-# Gen
-template_path, position_data = demonstrate_improved_layout()
 
     
\ No newline at end of file
@@ -1,72 +1,385 @@
+import io
 import cv2
 import time
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 import math
-import json
 import os
 
-def grade_with_precise_positions(binary_img, bubble_positions, expected_answers, threshold, debug=False):
+from compiled_template import compile_template, compile_pages, load_pages, page_for_code, decode_layout_code
+from align import align_template
+from debug_render import render_question_strips, debug_output_path, write_debug_overlay
+from triage import triage_sheet, alignment_review
+
+# Local threshold window used to binarize the scan
+ADAPTIVE_BLOCK_SIZE = 15
+ADAPTIVE_C = 10
+
+def scaled_block_size(scale):
+    """Threshold window for a scan decoded at `scale` times the template resolution"""
+    return max(3, int(round(ADAPTIVE_BLOCK_SIZE * scale)) | 1)
+
+def fit_template(template, gray):
+    """
+    Scale the template onto a decoded scan and pick the matching
+    threshold window. Returns (fitted_template, block_size).
+    """
+    fitted = template.fit_to(gray.shape)
+    
+    # A window about twice the bubble keeps a filled interior darker than
+    # its surroundings; a smaller one only picks up the rim of light marks
+    if fitted.bubble_diameter:
+        return fitted, max(3, int(round(2 * fitted.bubble_diameter)) | 1)
+    
+    scale = gray.shape[1] / template.page_size[0] if template.page_size else 1.0
+    return fitted, scaled_block_size(scale)
+
+def binarize(gray, scoring="mask", block_size=ADAPTIVE_BLOCK_SIZE):
+    """Adaptive threshold, plus the morphological clean-up that bbox scoring needs"""
+    binary = cv2.adaptiveThreshold(
+        gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, block_size, ADAPTIVE_C
+    )
+    
+    # Removing small noise (thin outlines only matter to bbox scoring)
+    if scoring == "bbox":
+        kernel = np.ones((3,3), np.uint8)
+        binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel)
+    return binary
+
+def binarize_roi_tiles(gray, template, scoring="mask", block_size=ADAPTIVE_BLOCK_SIZE):
+    """
+    Binarize only the tiles around the template's bubbles and leave the
+    rest of the page black. Tiles carry a margin of half the threshold
+    window (plus one pixel for the 3x3 opening), so every bubble pixel
+    gets exactly the value the full-page pass would give it.
+    """
+    h, w = gray.shape[:2]
+    binary = np.zeros_like(gray)
+    margin = block_size // 2 + 1
+    
+    for x1, y1, x2, y2 in template.roi_tiles(margin).tolist():
+        x1, y1 = max(0, x1), max(0, y1)
+        x2, y2 = min(w, x2), min(h, y2)
+        if x2 > x1 and y2 > y1:
+            binary[y1:y2, x1:x2] = binarize(gray[y1:y2, x1:x2], scoring, block_size)
+    return binary
+
+class StageTimer:
+    """
+    Wall time per pipeline stage. A disabled timer skips the clock
+    entirely, so leaving the calls in place costs next to nothing.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}
+        self._last = time.perf_counter() if enabled else 0.0
+
+    def lap(self, stage):
+        """Charge the time since the previous lap to `stage`"""
+        if self.enabled:
+            now = time.perf_counter()
+            self.stages[stage] = self.stages.get(stage, 0.0) + now - self._last
+            self._last = now
+
+def reduce_factor(scan_size, page_size):
+    """1, 2 or 4: how far a (w, h) scan can be downscaled and still cover the template page"""
+    oversample = min(scan_size[0] / page_size[0], scan_size[1] / page_size[1])
+    if oversample >= 4:
+        return 4
+    if oversample >= 2:
+        return 2
+    return 1
+
+def load_scan(image_path, page_size=None, reduce=True):
+    """
+    Decode a scan straight to grayscale. When the template page_size shows
+    the scan is oversampled 2x or 4x, the decoder downscales it on the fly
+    (IMREAD_REDUCED_GRAYSCALE_2/4), which only reads the image header up front.
+    """
+    flags = _decode_flags(image_path, page_size, reduce)
+    gray = cv2.imread(image_path, flags)
+    if gray is None:
+        raise ValueError(f"Could not load image from {image_path}")
+    return gray
+
+def decode_scan(data, page_size=None, reduce=True):
+    """
+    Same as load_scan for an encoded file already read into memory, so
+    disk or network reads can happen apart from decoding (cv2.imdecode).
+    """
+    flags = _decode_flags(io.BytesIO(data), page_size, reduce)
+    gray = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    if gray is None:
+        raise ValueError("Could not decode image data")
+    return gray
+
+def _decode_flags(source, page_size, reduce):
+    """Grayscale decode flag, reduced 2x/4x when the header shows the scan is oversampled"""
+    if not reduce or page_size is None:
+        return cv2.IMREAD_GRAYSCALE
+    try:
+        with Image.open(source) as header:
+            scan_size = header.size
+    except Exception:
+        return cv2.IMREAD_GRAYSCALE
+    
+    factor = reduce_factor(scan_size, page_size)
+    if factor == 4:
+        return cv2.IMREAD_REDUCED_GRAYSCALE_4
+    if factor == 2:
+        return cv2.IMREAD_REDUCED_GRAYSCALE_2
+    return cv2.IMREAD_GRAYSCALE
+
+def compute_fill_ratios(binary_img, bboxes):
+    """
+    Compute the filled pixel ratio of every bubble in a single pass
+    using an integral image. Returns a (questions x choices) float matrix.
+    """
+    h, w = binary_img.shape[:2]
+    integral = cv2.integral((binary_img > 0).astype(np.uint8))
+
+    # Clip to the page, same as slicing the ROI would
+    x1 = np.clip(bboxes[..., 0], 0, w)
+    y1 = np.clip(bboxes[..., 1], 0, h)
+    x2 = np.maximum(np.clip(bboxes[..., 2], 0, w), x1)
+    y2 = np.maximum(np.clip(bboxes[..., 3], 0, h), y1)
+
+    filled = integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+    area = (x2 - x1) * (y2 - y1)
+
+    ratios = np.zeros(bboxes.shape[:-1], dtype=np.float64)
+    np.divide(filled, area, out=ratios, where=area > 0)
+    return ratios
+
+def compute_mask_fill_ratios(binary_img, template):
+    """
+    Compute the filled pixel ratio of every bubble counting only pixels
+    inside its circular mask, so the printed outline and the bbox corners
+    never skew the ratio. All ROIs of one bubble size are gathered and
+    scored in one batched operation. Returns a (questions x choices) matrix.
+    """
+    h, w = binary_img.shape[:2]
+    ratios = np.zeros(template.bboxes.shape[:-1], dtype=np.float64)
+
+    for mask, q_idx, c_idx in template.mask_groups:
+        mask_h, mask_w = mask.shape
+        origins = template.bboxes[q_idx, c_idx, :2]
+        ys = origins[:, 1, None, None] + np.arange(mask_h)[None, :, None]
+        xs = origins[:, 0, None, None] + np.arange(mask_w)[None, None, :]
+
+        # Pixels falling off the page count as empty
+        inside = (ys >= 0) & (ys < h) & (xs >= 0) & (xs < w)
+        rois = binary_img[np.clip(ys, 0, h - 1), np.clip(xs, 0, w - 1)] > 0
+
+        filled = np.count_nonzero(rois & inside & mask, axis=(1, 2))
+        ratios[q_idx, c_idx] = filled / np.count_nonzero(mask)
+
+    return ratios
+
+def threshold_margins(fill_ratios, threshold, choice_mask=None):
+    """
+    Per question, how far its bubble closest to the threshold sits from it.
+    A small margin means a slightly lighter or darker mark would flip the call.
+    """
+    distance = np.abs(fill_ratios - threshold)
+    if choice_mask is not None:
+        distance = np.where(choice_mask, distance, np.inf)
+    return distance.min(axis=1, initial=np.inf)
+
+def choice_gaps(fill_ratios, choice_mask=None):
+    """
+    Per question, how far its darkest bubble is ahead of the second darkest.
+    A large gap on a MULTI question usually means one mark plus an erasure.
+    """
+    ratios = fill_ratios if choice_mask is None else np.where(choice_mask, fill_ratios, -np.inf)
+    if ratios.shape[1] < 2:
+        return ratios.max(axis=1, initial=0.0)
+    top_two = -np.partition(-ratios, 1, axis=1)[:, :2]
+    # A question with a single real choice has nothing to compete with
+    second = np.where(np.isfinite(top_two[:, 1]), top_two[:, 1], 0.0)
+    return np.maximum(top_two[:, 0], 0.0) - second
+
+def adaptive_threshold(fill_ratios, choice_mask=None, fallback=0.2, min_separation=0.1):
+    """
+    Per-sheet fill threshold from the sheet's own ratio matrix: Otsu's
+    two-cluster split over all bubble ratios, placed halfway between the
+    two sorted ratios it falls between. A sheet whose clusters are closer
+    than min_separation (all blank or all filled) keeps the fallback.
+    """
+    values = fill_ratios[choice_mask] if choice_mask is not None else fill_ratios.ravel()
+    values = np.sort(values)
+    if len(values) < 2:
+        return fallback
+    
+    # Between-class variance for every split point after index i
+    counts = np.arange(1, len(values))
+    cumsum = np.cumsum(values)[:-1]
+    total = values.sum()
+    mean_low = cumsum / counts
+    mean_high = (total - cumsum) / (len(values) - counts)
+    between = counts * (len(values) - counts) * (mean_high - mean_low) ** 2
+    
+    best = int(np.argmax(between))
+    if mean_high[best] - mean_low[best] < min_separation:
+        return fallback
+    return float((values[best] + values[best + 1]) / 2)
+
+# Answer codes for sheets scored as arrays; letters are their index in template.choices
+CODE_NONE = -1
+CODE_MULTI = -2
+CODE_UNKNOWN = -3
+
+def answer_codes(fill_ratios, choice_indices, threshold):
+    """
+    Read the answers of one (Q x C) or many (N x Q x C) ratio matrices at
+    once. threshold is a scalar or one value per sheet. Each answer is the
+    index of the marked choice, CODE_MULTI or CODE_NONE.
+    """
+    fill_ratios = np.asarray(fill_ratios)
+    threshold = np.asarray(threshold, dtype=np.float64)
+    if threshold.ndim:
+        threshold = threshold.reshape(threshold.shape + (1,) * (fill_ratios.ndim - threshold.ndim))
+    
+    marked = (fill_ratios > threshold) & (choice_indices >= 0)
+    counts = marked.sum(axis=-1)
+    first = np.argmax(marked, axis=-1)
+    chosen = np.take_along_axis(np.broadcast_to(choice_indices, marked.shape), first[..., None], axis=-1)[..., 0]
+    
+    codes = np.where(counts == 1, chosen, np.where(counts > 1, CODE_MULTI, CODE_NONE))
+    return codes.astype(np.int16)
+
+def encode_answer_key(expected_answers, template):
+    """
+    The key as one code per template question, looked up by question
+    number. Answers that are not one of the template choices never match.
     """
-    Grade using precisely KNOWN bubble positions
+    lookup = {choice: i for i, choice in enumerate(template.choices)}
+    return np.array([lookup.get(expected_answers[q_num - 1], CODE_UNKNOWN) for q_num in template.questions.tolist()],
+                    dtype=np.int16)
+
+def decode_answers(codes, choices):
+    """Turn answer codes back into letters, 'MULTI' and 'NONE'"""
+    labels = list(choices) + ['MULTI', 'NONE']
+    return [labels[c] for c in np.where(codes < 0, len(choices) + (codes == CODE_NONE), codes).tolist()]
+
+def score_sheets(fill_ratios, template, expected_answers, threshold=0.2):
+    """
+    Grade a whole class from stacked (N x Q x C) ratio matrices in one pass.
+    threshold is a scalar, one value per sheet (e.g. each sheet's
+    results['threshold']) or "auto". Returns the (N x Q) answer codes and
+    correctness, per-sheet scores and MULTI/NONE counts, and per-question
+    item statistics: the share of sheets answering it correctly, MULTI and
+    NONE.
+    """
+    template = compile_template(template)
+    fill_ratios = np.asarray(fill_ratios)
+    if isinstance(threshold, str) and threshold == "auto":
+        threshold = np.array([adaptive_threshold(r, template.choice_mask) for r in fill_ratios])
+    
+    codes = answer_codes(fill_ratios, template.choice_indices, threshold)
+    correct = codes == encode_answer_key(expected_answers, template)
+    multi = codes == CODE_MULTI
+    none = codes == CODE_NONE
+    total_scores = correct.sum(axis=1)
+    
+    return {
+        'codes': codes,
+        'correct': correct,
+        'total_scores': total_scores,
+        'max_score': template.num_questions,
+        'percentages': total_scores / max(template.num_questions, 1) * 100,
+        'multiple_answers': multi.sum(axis=1),
+        'unanswered': none.sum(axis=1),
+        'thresholds': np.broadcast_to(np.asarray(threshold, dtype=np.float64), (len(codes),)),
+        'item_correct': correct.mean(axis=0) if len(codes) else np.zeros(template.num_questions),
+        'item_multi': multi.mean(axis=0) if len(codes) else np.zeros(template.num_questions),
+        'item_none': none.mean(axis=0) if len(codes) else np.zeros(template.num_questions)
+    }
+
+def read_field(gray, field, block_size=ADAPTIVE_BLOCK_SIZE, threshold=0.5):
+    """
+    Read a bubble field outside the questions (see CompiledTemplate.fields)
+    from a scan the field is already fitted to. Returns (codes, fill_ratios)
+    with one answer code per field row.
+    """
+    binary = binarize_roi_tiles(gray, field, "mask", block_size)
+    fill_ratios = compute_mask_fill_ratios(binary, field)
+    return answer_codes(fill_ratios, field.choice_indices, threshold), fill_ratios
+
+def read_layout_code(gray, template, block_size=ADAPTIVE_BLOCK_SIZE):
+    """Layout code printed on a scan, read through a template fitted to it"""
+    field = template.fields.get('layout_code')
+    if field is None:
+        raise ValueError("Template has no layout code field")
+    codes, _ = read_field(gray, field, block_size)
+    code = decode_layout_code(codes >= 0)
+    if code is None:
+        raise ValueError("Could not read the layout code")
+    return code
+
+def grade_with_precise_positions(binary_img, bubble_positions, expected_answers, threshold, debug=False, scoring="mask", details=True):
+    """
+    Grade using precisely KNOWN bubble positions.
+    bubble_positions may be the raw list from the position file or a CompiledTemplate.
+    scoring="mask" counts pixels inside the bubble circle only,
+    scoring="bbox" counts the whole square bbox.
+    threshold="auto" derives the threshold from this sheet's ratios
+    (see adaptive_threshold); the value used is returned as 'threshold'
+    and each question's distance from it as 'margins'; 'top_gaps' holds
+    how far each question's darkest bubble leads the second darkest.
+    details=False skips the per-question result dicts; 'answers' always
+    holds each question's student answer.
     """
+    template = compile_template(bubble_positions)
     question_results = []
-    score = 0
     
     debug_img = cv2.cvtColor(binary_img, cv2.COLOR_GRAY2BGR) if debug else None
+
+    # Score every bubble at once, the loop below only reads the matrix
+    if scoring == "mask":
+        fill_ratios = compute_mask_fill_ratios(binary_img, template)
+    elif scoring == "bbox":
+        fill_ratios = compute_fill_ratios(binary_img, template.bboxes)
+    else:
+        raise ValueError(f"Unknown scoring mode: {scoring}")
     
-    for q_data in bubble_positions:
-        q_num = q_data['question']
-        bubbles = q_data['bubbles']
-        
-        bubble_status = {}
-        marked_choices = []
-        
-        for bubble in bubbles:
-            choice = bubble['choice']
-            x1, y1, x2, y2 = bubble['bbox']
-            
-            # Extracting the bubble region
-            bubble_roi = binary_img[max(0,y1):min(binary_img.shape[0],y2), 
-                                  max(0,x1):min(binary_img.shape[1],x2)]
-            
-            if bubble_roi.size == 0:
-                filled_ratio = 0
-            else:
-                total_pixels = bubble_roi.size
-                filled_pixels = np.sum(bubble_roi > 0)
-                filled_ratio = filled_pixels / total_pixels
-            
-            bubble_status[choice] = filled_ratio
-            
-            if filled_ratio > threshold:
-                marked_choices.append(choice)
+    if threshold == "auto":
+        threshold = adaptive_threshold(fill_ratios, template.choice_mask)
+    margins = threshold_margins(fill_ratios, threshold, template.choice_mask)
+    top_gaps = choice_gaps(fill_ratios, template.choice_mask)
+    
+    # Read and mark every question at once, the loop below only reports
+    codes = answer_codes(fill_ratios, template.choice_indices, threshold)
+    correct = codes == encode_answer_key(expected_answers, template)
+    score = int(correct.sum())
+    answers = decode_answers(codes, template.choices)
+    
+    for q_idx in range(template.num_questions if (details or debug) else 0):
+        q_num = int(template.questions[q_idx])
+        q_choices = [template.choices[i] for i in template.choice_indices[q_idx] if i >= 0]
         
-        # Determining answer
-        if len(marked_choices) == 1:
-            student_answer = marked_choices[0]
-            is_correct = (student_answer == expected_answers[q_num-1])
-            if is_correct:
-                score += 1
-        else:
-            student_answer = "MULTI" if len(marked_choices) > 1 else "NONE"
-            is_correct = False
+        bubble_status = dict(zip(q_choices, fill_ratios[q_idx].tolist()))
+        student_answer = answers[q_idx]
+        is_correct = bool(correct[q_idx])
         
-        question_results.append({
-            'question': q_num,
-            'student_answer': student_answer,
-            'correct_answer': expected_answers[q_num-1],
-            'is_correct': is_correct,
-            'bubble_status': bubble_status
-        })
+        if details:
+            question_results.append({
+                'question': q_num,
+                'student_answer': student_answer,
+                'correct_answer': expected_answers[q_num-1],
+                'is_correct': is_correct,
+                'bubble_status': bubble_status,
+                'margin': float(margins[q_idx]),
+                'top_gap': float(top_gaps[q_idx])
+            })
         
         # Debug mode
         if debug and debug_img is not None:
             correct_answer = expected_answers[q_num-1]
             
-            for bubble in bubbles:
-                choice = bubble['choice']
-                center_x, center_y = bubble['center']
+            for c_idx, choice in enumerate(q_choices):
+                center_x, center_y = template.centers[q_idx, c_idx].tolist()
                 filled_ratio = bubble_status[choice]
                 
                 # Determine colors based on answer status
@@ -94,7 +407,7 @@ def grade_with_precise_positions(binary_img, bubble_positions, expected_answers,
                            (center_x-25, center_y+35), cv2.FONT_HERSHEY_SIMPLEX, 0.4, color, 1)
             
             # Summary
-            question_pos = q_data.get('question_pos', (bubbles[0]['center'][0] - 100, bubbles[0]['center'][1]))
+            question_pos = template.question_pos[q_idx]
             summary_color = (0, 255, 0) if is_correct else (0, 0, 255)
             summary_text = f"Q{q_num}: Student={student_answer}, Correct={correct_answer} ({'✓' if is_correct else '✗'})"
             cv2.putText(debug_img, summary_text, 
@@ -115,11 +428,16 @@ def grade_with_precise_positions(binary_img, bubble_positions, expected_answers,
     
     return {
         'total_score': score,
-        'max_score': len(bubble_positions),
-        'percentage': (score / len(bubble_positions)) * 100,
+        'max_score': template.num_questions,
+        'percentage': (score / template.num_questions) * 100,
         'question_results': question_results,
-        'multiple_answers': len([r for r in question_results if r['student_answer'] == 'MULTI']),
-        'unanswered': len([r for r in question_results if r['student_answer'] == 'NONE'])
+        'answers': answers,
+        'fill_ratios': fill_ratios,
+        'threshold': threshold,
+        'margins': margins,
+        'top_gaps': top_gaps,
+        'multiple_answers': answers.count('MULTI'),
+        'unanswered': answers.count('NONE')
     }
 
 def grade_gabarito_improved(
@@ -128,40 +446,237 @@ def grade_gabarito_improved(
     position_data=None,
     choices=("A", "B", "C", "D", "E"),
     threshold=0.2,
-    debug=False
+    debug=False,
+    scoring="mask",
+    preprocess="roi",
+    reduce=True,
+    align=True,
+    details=True,
+    debug_output=None,
+    debug_anomalies_only=True,
+    debug_margin=0.05,
+    review_limit=None,
+    review_margin=0.1,
+    review_dir=None,
+    metrics=None,
+    sheet_name=None,
+    key_table=None,
+    registry=None
 ):
     """
-    Grade improved answer sheets with header labels
+    Grade improved answer sheets with header labels.
+    image_path may also be an already decoded grayscale page (see
+    scan_pages.iter_pages) or the raw bytes of an image file; sheet_name
+    then labels it in debug, review and metrics output.
+    threshold may be a fixed fill ratio or "auto" for a per-sheet
+    threshold computed from the sheet's own ratios.
+    With scoring="mask" the printed outline never reaches the score,
+    so the morphological clean-up pass is skipped.
+    preprocess="roi" binarizes only the bubble tiles, preprocess="page"
+    keeps the full-page pass as a fallback. reduce=True lets oversampled
+    scans decode at 1/2 or 1/4 resolution. align=True locates the printed
+    reference marks and maps the bubbles onto shifted or rotated scans.
+    
+    debug=True opens blocking OpenCV windows. For headless runs pass
+    debug_output (a .png path or a directory) instead: the affected
+    questions are cropped, annotated and written there without any window.
+    With debug_anomalies_only only MULTI/NONE questions and those within
+    debug_margin of the threshold are drawn, and clean sheets write nothing.
+    
+    review_limit=N triages the sheet: results['review'] is None when at
+    most N questions are within review_margin of the threshold (or are a
+    lopsided MULTI), otherwise it names them and, with review_dir set,
+    points to a thumbnail of their crops (see triage.triage_sheet).
+    A sheet whose reference marks were found but gave an untrustworthy
+    fit (see align.check_homography) is never scored as aligned: it goes
+    to review, or raises ValueError when review_limit is None.
+    
+    position_data may hold the pages of a multi-page layout (a {'pages':
+    [...]} dict or compiled_template.load_pages): the layout code printed
+    on the scan picks the page, returned as results['layout_code'].
+    key_table (an exam_versions.KeyTable) grades shuffled exam versions:
+    the printed version field is read first and the matching layout and
+    answer key are used; position_data and expected_answers may be None.
+    The version read is returned as results['version'].
+    registry (a template_registry.TemplateRegistry) grades mixed stacks:
+    the layout code printed under the footer picks the exam, page and key
+    (or key table), returned as results['exam'] and results['layout_code'].
+    Sheets generated with a student ID grid also get results['student_id'],
+    one digit per column and '?' where a column is blank or has several marks.
+    
+    metrics=True adds results['metrics']: wall time per stage, bytes
+    decoded, bubbles scored and MULTI/NONE/low-margin counts. Pass a
+    callable instead to also have it called with that dict per sheet.
     """
-    img = cv2.imread(image_path)
-    if img is None:
-        raise ValueError(f"Could not load image from {image_path}")
+    is_array = isinstance(image_path, np.ndarray)
+    is_bytes = isinstance(image_path, (bytes, bytearray, memoryview))
+    if sheet_name is None:
+        sheet_name = "sheet" if is_array or is_bytes else image_path
     
-    # Preprocess
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if position_data is None and registry is not None:
+        position_data = registry.reader
+    if position_data is None and key_table is not None:
+        position_data = key_table.pages
     
-    # Enhanced preprocessing
-    kernel = np.ones((3,3), np.uint8)
-    binary = cv2.adaptiveThreshold(
-        gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 15, 10
-    )
+    if position_data is None:
+        if not (is_array or is_bytes) and not os.path.exists(image_path):
+            raise ValueError(f"Could not load image from {image_path}")
+        print("Warning: No position data provided. You need to generate position data first.")
+        return None
+    
+    timer = StageTimer(enabled=bool(metrics))
+    
+    # Accepts the raw positions dict or CompiledTemplates built once up front;
+    # the pages of a multi-page layout share the page format and marks
+    pages = compile_pages(position_data)
+    template = pages[0]
+    
+    if is_array:
+        gray = image_path if image_path.ndim == 2 else cv2.cvtColor(image_path, cv2.COLOR_BGR2GRAY)
+    elif is_bytes:
+        gray = decode_scan(image_path, template.page_size, reduce)
+    else:
+        gray = load_scan(image_path, template.page_size, reduce)
+    timer.lap('decode')
+    
+    # Bubble coordinates and the threshold window follow the decoded resolution
+    template, block_size = fit_template(template, gray)
+    
+    # Map the bubbles onto the scan through the printed reference marks
+    alignment = None
+    if align:
+        template, alignment = align_template(gray, template)
+        if 'rejected' in alignment and review_limit is None:
+            raise ValueError(f"Could not align the sheet: {alignment['rejected']}")
+    timer.lap('align')
+    
+    # Registered layouts and the pages of one layout share the page format,
+    # so the marks found above map any of them onto the scan
+    layout_code = exam = None
+    if registry is not None or len(pages) > 1:
+        layout_code = read_layout_code(gray, template, block_size)
+        if registry is not None:
+            template, expected_answers, found_key_table, exam = registry.select(layout_code)
+            if found_key_table is not None:
+                key_table = found_key_table
+        else:
+            template = page_for_code(pages, layout_code)
+        template, block_size = fit_template(template, gray)
+        if alignment and alignment['aligned']:
+            template = template.warped(alignment['homography'])
+        timer.lap('layout')
+    
+    # Shuffled versions share the page, so the marks found above map any of them
+    version = None
+    if key_table is not None:
+        version = key_table.read_version(gray, template, block_size)
+        template, expected_answers = key_table.select(version, layout_code)
+        template, block_size = fit_template(template, gray)
+        if alignment and alignment['aligned']:
+            template = template.warped(alignment['homography'])
+        timer.lap('version')
     
-    # Removing small noise
-    binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel)
+    if preprocess == "roi":
+        binary = binarize_roi_tiles(gray, template, scoring, block_size)
+    elif preprocess == "page":
+        binary = binarize(gray, scoring, block_size)
+    else:
+        raise ValueError(f"Unknown preprocess mode: {preprocess}")
     
     if debug:
         print("Preprocessed binary image:")
         cv2.imshow("Binary Image", binary)
         cv2.waitKey(0)
         cv2.destroyAllWindows()
+    timer.lap('preprocess')
     
-    if position_data is None:
-        print("Warning: No position data provided. You need to generate position data first.")
-        return None
+    results = grade_with_precise_positions(binary, template, expected_answers, threshold, debug, scoring, details)
+    results['alignment'] = alignment
+    
+    # Student ID columns are read like answers, against the same threshold
+    if 'student_id' in template.fields:
+        id_field = template.fields['student_id']
+        codes, _ = read_field(gray, id_field, block_size, results['threshold'])
+        results['student_id'] = ''.join(id_field.choices[c] if c >= 0 else '?' for c in codes.tolist())
+    if key_table is not None:
+        results['version'] = version
+    if registry is not None:
+        results['exam'] = exam
+    if layout_code is not None:
+        results['layout_code'] = layout_code
+    timer.lap('score')
+    
+    if debug_output is not None:
+        flagged = np.arange(template.num_questions)
+        if debug_anomalies_only:
+            undecided = np.isin(results['answers'], ['MULTI', 'NONE'])
+            flagged = np.nonzero(undecided | (results['margins'] < debug_margin))[0]
+        
+        results['debug_image'] = None
+        if len(flagged):
+            overlay = render_question_strips(gray, template, results['fill_ratios'], results['answers'],
+                                             expected_answers, results['threshold'], flagged)
+            if overlay is not None:
+                results['debug_image'] = write_debug_overlay(debug_output_path(debug_output, sheet_name), overlay)
+        timer.lap('debug')
+    
+    if review_limit is not None:
+        if alignment is not None and 'rejected' in alignment:
+            results['review'] = alignment_review(alignment['rejected'])
+        else:
+            results['review'] = triage_sheet(results, gray, template, expected_answers, sheet_name,
+                                             review_limit, review_margin, review_dir)
+        timer.lap('triage')
     
-    bubble_positions = position_data['bubble_positions']
+    if metrics:
+        sheet_metrics = {
+            'image_path': sheet_name,
+            'stages': timer.stages,
+            'total_seconds': sum(timer.stages.values()),
+            'bytes_decoded': gray.nbytes,
+            'image_shape': gray.shape[:2],
+            'bubbles_scored': int(template.choice_mask.sum()),
+            'questions': template.num_questions,
+            'multiple_answers': results['multiple_answers'],
+            'unanswered': results['unanswered'],
+            'low_margin': int((results['margins'] < debug_margin).sum()),
+            'threshold': results['threshold'],
+            'marks_found': alignment['marks_found'] if alignment else None
+        }
+        results['metrics'] = sheet_metrics
+        if callable(metrics):
+            metrics(sheet_metrics)
     
-    return grade_with_precise_positions(binary, bubble_positions, expected_answers, threshold, debug)
+    return results
+
+def time_preprocessing(image_path, position_data, scoring="mask", repeat=5):
+    """
+    Time full-page and ROI-only binarization on one scan and check that
+    both give the same fill ratios
+    """
+    template = compile_template(position_data)
+    gray = load_scan(image_path, template.page_size)
+    template, block_size = fit_template(template, gray)
+    
+    timings = {}
+    ratios = {}
+    for mode, run in (("page", lambda: binarize(gray, scoring, block_size)),
+                      ("roi", lambda: binarize_roi_tiles(gray, template, scoring, block_size))):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            binary = run()
+        timings[mode] = (time.perf_counter() - start) / repeat
+        if scoring == "mask":
+            ratios[mode] = compute_mask_fill_ratios(binary, template)
+        else:
+            ratios[mode] = compute_fill_ratios(binary, template.bboxes)
+    
+    return {
+        'page_seconds': timings['page'],
+        'roi_seconds': timings['roi'],
+        'speedup': timings['page'] / timings['roi'] if timings['roi'] > 0 else float('inf'),
+        'max_ratio_diff': float(np.abs(ratios['page'] - ratios['roi']).max(initial=0.0))
+    }
 
 def print_grade_report(grade_results):
     """Print a formatted grade report"""
@@ -171,6 +686,8 @@ def print_grade_report(grade_results):
     print(f"Percentage: {results['percentage']:.1f}%")
     print(f"Multiple answers: {results['multiple_answers']}")
     print(f"Unanswered: {results['unanswered']}")
+    if 'threshold' in results:
+        print(f"Threshold: {results['threshold']:.3f}")
     
     # Calculate accuracy for answered questions
     answered_questions = len(results['question_results']) - results['unanswered'] - results['multiple_answers']
@@ -198,7 +715,7 @@ def print_grade_report(grade_results):
     if incorrect:
         for item in incorrect:
             if item['student_answer'] == 'MULTI':
-                marked = [ch for ch, ratio in item['bubble_status'].items() if ratio > 0.4]
+                marked = [ch for ch, ratio in item['bubble_status'].items() if ratio > results.get('threshold', 0.2)]
                 print(f"Q{item['question']:02d}: MULTIPLE answers {marked}, Correct={item['correct_answer']}")
             elif item['student_answer'] == 'NONE':
                 print(f"Q{item['question']:02d}: UNANSWERED, Correct={item['correct_answer']}")
@@ -216,8 +733,7 @@ if __name__ == "__main__":
     print(f"Using marked sample: {marked_path}")
     
     # Load position data
-    with open(position_file, 'r') as f:
-        position_data = json.load(f)
+    position_data = load_pages(position_file)
     
     expected_answers = ["A", "B", "D", "E", "E", "E", "D", "B", "A", "A", 
                        "C", "C", "C", "D", "E", "A", "E", "B", "A", "E",
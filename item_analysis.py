@@ -0,0 +1,157 @@
+import csv
+
+import numpy as np
+
+from compiled_template import compile_template
+from grade_it import answer_codes, encode_answer_key, CODE_MULTI, CODE_NONE
+
+class ItemAnalysis:
+    """
+    Item statistics for a batch, accumulated one sheet (or one block of
+    sheets) at a time. Only running sums are kept, so memory does not grow
+    with the number of sheets:
+
+        analysis = ItemAnalysis(template, expected_answers)
+        for results in grade_batch(...):
+            analysis.add_results(results)
+        stats = analysis.statistics()
+
+    Columns of the choice tables are the template choices followed by
+    MULTI and NONE.
+    """
+
+    def __init__(self, template, expected_answers):
+        self.template = compile_template(template)
+        self.expected_answers = expected_answers
+        self.key_codes = encode_answer_key(expected_answers, self.template)
+        self.labels = list(self.template.choices) + ['MULTI', 'NONE']
+
+        num_questions = self.template.num_questions
+        self.sheets = 0
+        self.score_sum = 0.0
+        self.score_sq_sum = 0.0
+        self.correct = np.zeros(num_questions, dtype=np.int64)
+        # Sum of the total scores of the sheets that got each question right
+        self.correct_score_sum = np.zeros(num_questions, dtype=np.float64)
+        self.choice_counts = np.zeros((num_questions, len(self.labels)), dtype=np.int64)
+        self.choice_score_sum = np.zeros((num_questions, len(self.labels)), dtype=np.float64)
+
+    def _columns(self, codes):
+        """Answer codes -> column in the choice tables"""
+        num_choices = len(self.template.choices)
+        return np.where(codes == CODE_MULTI, num_choices, np.where(codes == CODE_NONE, num_choices + 1, codes))
+
+    def add(self, codes):
+        """Add one sheet's (Q,) or a block of sheets' (N, Q) answer codes"""
+        codes = np.atleast_2d(np.asarray(codes))
+        if codes.shape[1] != self.template.num_questions:
+            raise ValueError(f"Expected {self.template.num_questions} answers per sheet, got {codes.shape[1]}")
+
+        correct = codes == self.key_codes
+        scores = correct.sum(axis=1).astype(np.float64)
+
+        self.sheets += len(codes)
+        self.score_sum += scores.sum()
+        self.score_sq_sum += (scores ** 2).sum()
+        self.correct += correct.sum(axis=0)
+        self.correct_score_sum += scores @ correct
+
+        columns = self._columns(codes)
+        q_idx = np.broadcast_to(np.arange(codes.shape[1]), codes.shape)
+        np.add.at(self.choice_counts, (q_idx, columns), 1)
+        np.add.at(self.choice_score_sum, (q_idx, columns), np.broadcast_to(scores[:, None], codes.shape))
+
+    def add_ratios(self, fill_ratios, threshold):
+        """Add one (Q x C) or many (N x Q x C) ratio matrices read at threshold"""
+        self.add(answer_codes(fill_ratios, self.template.choice_indices, threshold))
+
+    def add_results(self, results):
+        """Add a graded sheet; failed sheets (with an 'error') are skipped"""
+        if 'error' in results:
+            return
+        self.add_ratios(results['fill_ratios'], results['threshold'])
+
+    def statistics(self):
+        """
+        Per question: 'difficulty' (share answering correctly) and
+        'discrimination', the point-biserial correlation between getting
+        the question right and the score on the remaining questions.
+        NaN where it is undefined (everyone or no one right, no spread).
+        """
+        n = self.sheets
+        if n == 0:
+            nan = np.full(self.template.num_questions, np.nan)
+            return {'sheets': 0, 'mean_score': np.nan, 'score_std': np.nan,
+                    'difficulty': nan, 'discrimination': nan.copy()}
+
+        mean_score = self.score_sum / n
+        score_std = np.sqrt(max(self.score_sq_sum / n - mean_score ** 2, 0.0))
+        right = self.correct.astype(np.float64)
+        wrong = n - right
+        p = right / n
+
+        # Rest score = total minus this question, built from the same sums
+        rest_sum = self.score_sum - right
+        rest_sq_sum = self.score_sq_sum - 2 * self.correct_score_sum + right
+        rest_std = np.sqrt(np.maximum(rest_sq_sum / n - (rest_sum / n) ** 2, 0.0))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_right = (self.correct_score_sum - right) / right
+            mean_wrong = (self.score_sum - self.correct_score_sum) / wrong
+            discrimination = (mean_right - mean_wrong) / rest_std * np.sqrt(p * (1 - p))
+        discrimination[(right == 0) | (wrong == 0) | (rest_std == 0)] = np.nan
+
+        return {
+            'sheets': n,
+            'mean_score': mean_score,
+            'score_std': score_std,
+            'difficulty': p,
+            'discrimination': discrimination
+        }
+
+    def distractor_table(self):
+        """
+        One row per question: how many sheets picked each choice (plus
+        MULTI and NONE), the share that is, and the mean total score of
+        the sheets behind each column. A distractor whose pickers score
+        as well as the key's usually points to an ambiguous question.
+        """
+        rows = []
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_scores = self.choice_score_sum / self.choice_counts
+        for q_idx, q_num in enumerate(self.template.questions.tolist()):
+            counts = self.choice_counts[q_idx]
+            rows.append({
+                'question': q_num,
+                'key': self.expected_answers[q_num - 1],
+                'counts': dict(zip(self.labels, counts.tolist())),
+                'shares': dict(zip(self.labels, (counts / self.sheets if self.sheets else counts * 0.0).tolist())),
+                'mean_scores': dict(zip(self.labels, [None if c == 0 else float(m)
+                                                      for c, m in zip(counts, mean_scores[q_idx])]))
+            })
+        return rows
+
+    def write_csv(self, path):
+        """Item statistics and choice counts, one row per question"""
+        stats = self.statistics()
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['question', 'key', 'difficulty', 'discrimination'] + self.labels)
+            for q_idx, row in enumerate(self.distractor_table()):
+                writer.writerow([row['question'], row['key'],
+                                 round(float(stats['difficulty'][q_idx]), 4),
+                                 round(float(stats['discrimination'][q_idx]), 4)] +
+                                [row['counts'][label] for label in self.labels])
+        return path
+
+def print_item_report(analysis):
+    """Print difficulty, discrimination and choice counts per question"""
+    stats = analysis.statistics()
+    print(f"\n=== ITEM ANALYSIS ({stats['sheets']} sheets, mean score "
+          f"{stats['mean_score']:.2f} +/- {stats['score_std']:.2f}) ===")
+    print(f"{'Q':<3}  {'key':>5} {'p':>6} {'r_pb':>6}  " + " ".join(f"{label:>5}" for label in analysis.labels))
+    for q_idx, row in enumerate(analysis.distractor_table()):
+        discrimination = stats['discrimination'][q_idx]
+        r_pb = "   n/a" if np.isnan(discrimination) else f"{discrimination:>6.2f}"
+        counts = " ".join(f"{row['counts'][label]:>5}" for label in analysis.labels)
+        print(f"Q{row['question']:02d}  {row['key']:>5} {stats['difficulty'][q_idx]:>6.2f} {r_pb}  {counts}")
@@ -0,0 +1,147 @@
+import csv
+import json
+import queue
+import threading
+
+# One-character codes for the special answers in compact rows
+ANSWER_CODES = {'MULTI': '*', 'NONE': '-'}
+
+CSV_FIELDS = ['sheet', 'student_id', 'score', 'max_score', 'percentage', 'multiple_answers', 'unanswered', 'answers', 'version', 'exam', 'error']
+
+def encode_answers(answers):
+    """
+    Pack a sheet's answers into one string: the chosen letter, '*' for
+    MULTI and '-' for NONE. Multi-character choices are space separated.
+    """
+    codes = [ANSWER_CODES.get(a, a) for a in answers]
+    separator = '' if all(len(c) == 1 for c in codes) else ' '
+    return separator.join(codes)
+
+def compact_row(results, sheet=None, include_ratios=False):
+    """One flat dict per sheet, small enough to keep streaming"""
+    sheet = sheet if sheet is not None else results.get('image_path')
+    if 'error' in results:
+        return {'sheet': sheet, 'error': results['error']}
+
+    answers = results.get('answers')
+    if answers is None:
+        answers = [r['student_answer'] for r in results['question_results']]
+
+    row = {
+        'sheet': sheet,
+        'score': results['total_score'],
+        'max_score': results['max_score'],
+        'percentage': round(results['percentage'], 2),
+        'multiple_answers': results['multiple_answers'],
+        'unanswered': results['unanswered'],
+        'answers': encode_answers(answers)
+    }
+    if results.get('student_id') is not None:
+        row['student_id'] = results['student_id']
+    if results.get('version') is not None:
+        row['version'] = results['version']
+    if results.get('exam') is not None:
+        row['exam'] = results['exam']
+    if include_ratios and results.get('fill_ratios') is not None:
+        row['fill_ratios'] = [[round(r, 3) for r in q] for q in results['fill_ratios'].tolist()]
+    return row
+
+class ResultsWriter:
+    """
+    Stream one compact row per graded sheet to a CSV or JSONL file.
+    Every row is flushed as soon as it is written, so a crash mid-batch
+    keeps everything graded so far and nothing is held in memory.
+
+        with ResultsWriter("results.csv") as writer:
+            for results in grade_batch(...):
+                writer.write(results)
+    """
+
+    def __init__(self, path, fmt=None, include_ratios=False):
+        if fmt is None:
+            fmt = 'jsonl' if path.lower().endswith(('.jsonl', '.json')) else 'csv'
+        if fmt not in ('csv', 'jsonl'):
+            raise ValueError(f"Unknown results format: {fmt}")
+
+        self.path = path
+        self.fmt = fmt
+        self.include_ratios = include_ratios
+        self.rows_written = 0
+
+        self._file = open(path, 'w', newline='' if fmt == 'csv' else None, encoding='utf-8')
+        if fmt == 'csv':
+            fields = CSV_FIELDS + (['fill_ratios'] if include_ratios else [])
+            self._csv = csv.DictWriter(self._file, fieldnames=fields)
+            self._csv.writeheader()
+            self._file.flush()
+
+    def write(self, results, sheet=None):
+        row = compact_row(results, sheet, self.include_ratios)
+        if self.fmt == 'csv':
+            if 'fill_ratios' in row:
+                row['fill_ratios'] = json.dumps(row['fill_ratios'], separators=(',', ':'))
+            self._csv.writerow(row)
+        else:
+            self._file.write(json.dumps(row, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self._file.flush()
+        self.rows_written += 1
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class ThreadedWriter:
+    """
+    Run another writer's write() calls on a background thread, fed through
+    a bounded queue, so slow output storage does not hold up the grading
+    loop. Errors raised by the wrapped writer surface on the next write()
+    or on close(), which also drains the queue and closes the wrapped writer.
+    """
+
+    _DONE = object()
+
+    def __init__(self, writer, max_queued=64):
+        self.writer = writer
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._error = None
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def _drain(self):
+        while True:
+            item = self._queue.get()
+            if item is self._DONE:
+                return
+            if self._error is None:
+                try:
+                    self.writer.write(*item)
+                except Exception as e:
+                    self._error = e
+
+    def _raise_pending(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(self, results, sheet=None):
+        self._raise_pending()
+        self._queue.put((results, sheet))
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(self._DONE)
+            self._thread.join()
+            self.writer.close()
+        self._raise_pending()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,113 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from grade_it import load_scan, reduce_factor
+
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+PDF_EXTENSIONS = ('.pdf',)
+
+# Raster resolution for PDF pages when no template page size is known
+PDF_DEFAULT_DPI = 150
+
+def _open_pdf(path):
+    try:
+        import pymupdf
+    except ImportError:
+        raise ValueError(f"Reading {path} needs PyMuPDF (pip install pymupdf)")
+    # Corrupt or truncated files raise pymupdf's own errors
+    try:
+        return pymupdf, pymupdf.open(path)
+    except Exception as e:
+        raise ValueError(f"Could not open {path}: {e}")
+
+def count_pages(path):
+    """Number of sheets in a scan file, reading only its header"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in PDF_EXTENSIONS:
+        _, doc = _open_pdf(path)
+        with doc:
+            return doc.page_count
+    if ext in TIFF_EXTENSIONS:
+        try:
+            with Image.open(path) as tiff:
+                return getattr(tiff, 'n_frames', 1)
+        except Exception:
+            return 1
+    return 1
+
+def _tiff_frame_to_gray(frame, page_size=None, reduce=True):
+    gray = frame.convert("L")
+    if reduce and page_size is not None:
+        factor = reduce_factor(gray.size, page_size)
+        if factor > 1:
+            gray = gray.reduce(factor)
+    return np.asarray(gray)
+
+def _pdf_page_to_gray(pymupdf, page, page_size=None):
+    # Rasterize straight to the template resolution when it is known
+    if page_size is not None:
+        zoom = min(page_size[0] / page.rect.width, page_size[1] / page.rect.height)
+    else:
+        zoom = PDF_DEFAULT_DPI / 72
+    pix = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), colorspace=pymupdf.csGRAY, alpha=False)
+    rows = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)
+    return rows[:, :pix.width].copy()
+
+def load_page(path, page, page_size=None, reduce=True):
+    """
+    Decode a single page (0-based) of a scan file to grayscale. TIFF
+    frames are seeked to without decoding the ones before them and PDF
+    pages are rasterized on their own, so any page can be loaded in a
+    worker from just (path, page).
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in PDF_EXTENSIONS:
+        pymupdf, doc = _open_pdf(path)
+        with doc:
+            if not 0 <= page < doc.page_count:
+                raise ValueError(f"{path} has no page {page + 1}")
+            return _pdf_page_to_gray(pymupdf, doc.load_page(page), page_size)
+    if page == 0 and ext not in TIFF_EXTENSIONS:
+        return load_scan(path, page_size, reduce)
+    try:
+        with Image.open(path) as tiff:
+            tiff.seek(page)
+            return _tiff_frame_to_gray(tiff, page_size, reduce)
+    except EOFError:
+        raise ValueError(f"{path} has no page {page + 1}")
+    except OSError as e:
+        raise ValueError(f"Could not load page {page + 1} of {path}: {e}")
+
+def page_name(path, page):
+    """
+    Label for one page of a multi-page file: the name the page would have
+    if the file were split, e.g. scans/batch_p0003.tif for page 3
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}_p{page + 1:04d}{ext}"
+
+def iter_pages(path, page_size=None, reduce=True):
+    """
+    Yield (name, gray) for every sheet in a scan file, one page at a time.
+    Multi-page TIFFs and PDFs are decoded page by page as the consumer
+    asks for them, so a 500-page file never sits decoded in memory.
+    A plain image yields itself once under its own path.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in PDF_EXTENSIONS:
+        pymupdf, doc = _open_pdf(path)
+        with doc:
+            for page in range(doc.page_count):
+                yield page_name(path, page), _pdf_page_to_gray(pymupdf, doc.load_page(page), page_size)
+        return
+
+    if count_pages(path) <= 1:
+        yield path, load_scan(path, page_size, reduce)
+        return
+
+    with Image.open(path) as tiff:
+        for page in range(tiff.n_frames):
+            tiff.seek(page)
+            yield page_name(path, page), _tiff_frame_to_gray(tiff, page_size, reduce)
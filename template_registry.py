@@ -0,0 +1,97 @@
+import os
+import json
+
+from compiled_template import load_pages, compile_pages
+from exam_versions import KeyTable, load_answer_key
+
+class TemplateRegistry:
+    """
+    Every exam of a mixed stack, compiled once and looked up by the layout
+    code generate_gabarito_png_improved prints under the footer of each
+    page. The grader aligns the scan, reads the code from its few squares
+    and scores the sheet against the matching page and key:
+
+        registry = TemplateRegistry()
+        registry.register("math_positions.json", "A,B,C,...", name="math")
+        registry.register_key_table(KeyTable.load("physics_keys.json"), name="physics")
+        results = grade_gabarito_improved(scan, None, registry=registry)
+
+    Every page of a multi-page layout is registered under its own code,
+    with the whole key. Shuffled versions share their page's code, so a
+    key table is registered as one entry per page whose version is read next.
+    All registered pages must share one page format, since the reference
+    marks found before the code is read come from reader.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.reader = None
+
+    def _add(self, template, expected_answers, key_table, name):
+        code = template.layout_code
+        if code is None or 'layout_code' not in template.fields:
+            raise ValueError(f"Template '{name}' has no printed layout code; generate it again")
+        if code in self.entries:
+            raise ValueError(f"Layout code {code} of '{name}' is already used by '{self.entries[code][3]}'")
+
+        if self.reader is None:
+            self.reader = template
+        elif (template.page_size, template.margin) != (self.reader.page_size, self.reader.margin):
+            raise ValueError(f"Template '{name}' has a {template.page_size} page; "
+                             f"this registry holds {self.reader.page_size} pages")
+        self.entries[code] = (template, expected_answers, key_table, name)
+
+    def register(self, position_data, expected_answers, name=None):
+        """Add a layout (positions file, dict or compiled template) and its answer key"""
+        if isinstance(position_data, str):
+            name = name or os.path.basename(position_data)
+            pages = load_pages(position_data)
+        else:
+            pages = compile_pages(position_data)
+        name = name or f"layout {len(self.entries) + 1}"
+        for template in pages:
+            self._add(template, list(expected_answers), None, name)
+
+    def register_key_table(self, key_table, name=None):
+        """Add the versions of a shuffled exam (an exam_versions.KeyTable)"""
+        name = name or f"layout {len(self.entries) + 1}"
+        codes = {tuple(template.layout_code for template in pages) for pages, _ in key_table.versions.values()}
+        if len(codes) > 1:
+            raise ValueError(f"The versions of '{name}' do not share their layout codes")
+        for template in key_table.pages:
+            self._add(template, None, key_table, name)
+
+    def select(self, code):
+        """(template, expected_answers, key_table, name) for a layout code"""
+        if code not in self.entries:
+            raise ValueError(f"Layout code {code} is not in the registry")
+        return self.entries[code]
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a JSON file naming each exam with its positions file and key,
+        or with a key table for shuffled versions:
+
+            {"math": {"positions": "math_positions.tpl", "answers": "A,B,C,..."},
+             "physics": {"key_table": "physics_keys.json"}}
+
+        Relative paths are resolved against the file's own folder.
+        """
+        folder = os.path.dirname(os.path.abspath(path))
+        with open(path, 'r') as f:
+            table = json.load(f)
+
+        def resolve(p):
+            return p if os.path.isabs(p) else os.path.join(folder, p)
+
+        registry = cls()
+        for name, entry in table.items():
+            if 'key_table' in entry:
+                registry.register_key_table(KeyTable.load(resolve(entry['key_table'])), name)
+                continue
+            answers = entry['answers']
+            if isinstance(answers, str) and os.path.isfile(resolve(answers)):
+                answers = resolve(answers)
+            registry.register(resolve(entry['positions']), load_answer_key(answers), name)
+        return registry
@@ -0,0 +1,103 @@
+import os
+import json
+
+import numpy as np
+
+from debug_render import render_question_strips, write_debug_overlay
+from results_writer import compact_row
+
+# A MULTI whose darkest bubble leads the next one by this much is more
+# likely a mark plus a poor erasure than two real answers
+ERASURE_GAP = 0.3
+
+def low_confidence_questions(results, review_margin=0.1, erasure_gap=ERASURE_GAP):
+    """
+    Indices of the questions whose call was close: a bubble within
+    review_margin of the threshold, or a MULTI where one bubble clearly
+    dominates the others.
+    """
+    close = results['margins'] < review_margin
+    lopsided = np.isin(results['answers'], ['MULTI']) & (results['top_gaps'] >= erasure_gap)
+    return np.nonzero(close | lopsided)[0]
+
+def triage_sheet(results, gray, template, expected_answers, image_path, review_limit=0,
+                 review_margin=0.1, review_dir=None):
+    """
+    Decide whether a graded sheet needs a human. Returns None for a clear
+    sheet, otherwise {'reason', 'questions', 'question_indices', 'thumbnail'} naming
+    the low-confidence questions. More than review_limit of them sends the
+    sheet to review; with review_dir set the flagged questions are cropped
+    from the scan and written there as one thumbnail strip.
+    """
+    flagged = low_confidence_questions(results, review_margin)
+    if len(flagged) <= review_limit:
+        return None
+
+    thumbnail = None
+    if review_dir is not None:
+        overlay = render_question_strips(gray, template, results['fill_ratios'], results['answers'],
+                                         expected_answers, results['threshold'], flagged)
+        if overlay is not None:
+            stem = os.path.splitext(os.path.basename(image_path))[0]
+            thumbnail = write_debug_overlay(os.path.join(review_dir, f"{stem}_review.png"), overlay)
+
+    return {
+        'reason': 'low confidence',
+        'questions': template.questions[flagged].tolist(),
+        'question_indices': flagged.tolist(),
+        'thumbnail': thumbnail
+    }
+
+def alignment_review(reason):
+    """Review entry for a sheet whose reference marks could not be trusted"""
+    return {'reason': f"alignment: {reason}", 'questions': [], 'question_indices': [], 'thumbnail': None}
+
+def review_row(results, sheet=None):
+    """The compact row plus what a reviewer needs for each flagged question"""
+    row = compact_row(results, sheet)
+    review = results['review']
+    row['reason'] = review['reason']
+    row['thumbnail'] = review['thumbnail']
+    row['low_confidence'] = [{
+        'question': q_num,
+        'answer': results['answers'][q_idx],
+        'margin': round(float(results['margins'][q_idx]), 3),
+        'top_gap': round(float(results['top_gaps'][q_idx]), 3),
+        'ratios': [round(r, 3) for r in results['fill_ratios'][q_idx].tolist()]
+    } for q_num, q_idx in zip(review['questions'], review['question_indices'])]
+    return row
+
+class ReviewQueue:
+    """
+    JSONL file of the sheets triage_sheet flagged, one row per sheet,
+    flushed as it is written. Sheets without a 'review' entry are refused,
+    so the caller routes clear sheets to its normal output.
+
+        with ReviewQueue("review.jsonl") as queue:
+            for results in grade_batch(..., review_limit=0):
+                if results.get('review'):
+                    queue.write(results)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows_written = 0
+        self._file = open(path, 'w', encoding='utf-8')
+
+    def write(self, results, sheet=None):
+        if not results.get('review'):
+            raise ValueError("Sheet was not flagged for review")
+        row = review_row(results, sheet)
+        self._file.write(json.dumps(row, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self._file.flush()
+        self.rows_written += 1
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()